@@ -1,8 +1,33 @@
 import os
 import gc
+import json
+import time
+import hashlib
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import constant
 from eval import full_eval, submit_for_eval
 from data import *
-from preprocessing import preprocess
+from preprocessing import preprocess, Preprocessor, polynomial_expand
+from profiling import timed
+
+
+# config entries defining the train/valid/test matrices (see BaseModel.dataset_cache_path)
+DATASET_KEYS = ["features", "drops", "additional_features", "data_split_mode", "train_start", "train_end",
+    "valid_start", "valid_end", "test_start", "test_end", "random_seed", "random_split_ratio", "compact"]
+DATASET_KEY_PREFIXES = ("preprocessing", "target", "fillna", "polynomial")
+
+def run_fold(model, x, y, folds, i, nthread):
+    valid = folds[i]
+    train = np.sort(np.concatenate([f for j, f in enumerate(folds) if j != i]))
+    # shallow copy holding the fold's model: folds can run in parallel threads without touching model.model
+    fold = copy.copy(model)
+    fold.model = model.fit_fold(x[train], y[train], x[valid], y[valid], nthread)
+    pred = fold.predict_from_x(x[valid], nthread=nthread)
+    return np.abs(pred.reshape(-1) - y[valid].reshape(-1)).mean()
 
 
 class BaseModel:
@@ -17,6 +42,20 @@ class BaseModel:
         self.xsubmit = None
         self.submitindex = None
         self.params = config["params"]
+        self.preprocessor = Preprocessor(config)
+        self.nthread = config["nthread"] or os.cpu_count() # cpu budget of the model
+        self.kfold = config["kfold"]
+        self.cv_jobs = config["cv_jobs"] or 1
+        self.compact = config["compact"] # float32 features and matrices
+        self.matrix_dtype = np.float32 if self.compact else None
+        self.matrices = dict() # model matrix of each split, materialized once
+        self.feature_names = None # columns of the matrices
+        self.feature_dtypes = None
+        self.keep_frames = False # models working on the frames keep them next to the matrices
+        self.train_ready = False
+        self.train_dates = None
+        self.predict_threads = config["predict_threads"] or self.nthread
+        self.predict_chunk_size = config["predict_chunk_size"] or 100000
         return
 
     def has_params(self):
@@ -31,32 +70,112 @@ class BaseModel:
     def train(self):
         raise NotImplementedError("This is BaseModel class")
 
+    def fit_fold(self, xtrain, ytrain, xvalid, yvalid, nthread):
+        """
+        Train a new model on one fold (without touching self.model) and return it
+        """
+        raise NotImplementedError("This is BaseModel class")
+
     def save(self):
         raise NotImplementedError("This is BaseModel class")
 
     def load(self):
         raise NotImplementedError("This is BaseModel class")
 
-    def predict_from_x(self, x):
+    def save_preprocessing(self, path=None):
+        """
+        Save the fitted preprocessing statistics (default: next to the params file)
+        """
+        path = path or self.params + ".preprocessing.json"
+        self.preprocessor.save(path)
+
+    def load_preprocessing(self, path=None):
+        path = path or self.params + ".preprocessing.json"
+        if self.preprocessor.load(path):
+            print("Loaded preprocessing state from: {}".format(path))
+        elif self.preprocessor.needs_state("submit"):
+            # fit the statistics now rather than failing after the submit data is merged
+            print("No preprocessing state at: {}, fitting it with the train data".format(path))
+            self.ensure_train_data()
+        else:
+            print("No preprocessing state at: {}".format(path))
+
+    def predict_from_x(self, x, nthread=None):
+        """
+        Predict rows of x using at most nthread threads (backend default if None)
+        """
         raise NotImplementedError("This is BaseModel class")
 
     def predict(self, cat):
         x = self.get_x(cat)
-        return self.predict_from_x(x)
+        return self.predict_chunked(x)
+
+    @timed("predict")
+    def predict_chunked(self, x):
+        """
+        Score x in row blocks of predict_chunk_size on up to predict_threads threads,
+        the model's thread budget being split between the blocks in flight
+        """
+        n = x.shape[0]
+        size = self.predict_chunk_size
+        starts = range(0, n, size)
+        jobs = min(self.predict_threads, len(starts))
+        if jobs < 2:
+            return self.predict_from_x(x, nthread=self.nthread)
+        nthread = max(1, self.nthread // jobs)
+        # a single row first: gives the output shape/dtype and lets the backend settle its thread count
+        first = np.asarray(self.predict_from_x(x[:1], nthread=nthread))
+        pred = np.empty((n,) + first.shape[1:], dtype=first.dtype)
+        def predict_block(start):
+            pred[start:start + size] = self.predict_from_x(x[start:start + size], nthread=nthread)
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(predict_block, starts))
+        return pred
+
+    def ensure_train_data(self):
+        # train data may have been skipped (cached binary datasets, loaded model)
+        if not self.train_ready:
+            print("Initializing train data...")
+            self.init_train_data()
 
     def get_x(self, cat):
-        if cat == "train":
-            return self.xtrain.values
-        elif cat == "valid":
-            return self.xvalid.values
-        elif cat == "test":
-            return self.xtest.values
-        elif cat == "submit":
-            return self.xsubmit.values
-        else:
+        if cat != "submit":
+            self.ensure_train_data()
+        if cat in self.matrices:
+            return self.matrices[cat]
+        frames = {"train": self.xtrain, "valid": self.xvalid, "test": self.xtest, "submit": self.xsubmit}
+        if cat not in frames:
             raise ValueError("Unknown category '{}'".format(cat))
+        return self.materialize(cat, frames[cat])
+
+    def materialize(self, cat, df):
+        """
+        Convert a split to its model matrix once (C-contiguous array, or CSR with sparse columns),
+        column names and dtypes are kept as metadata
+        """
+        self.feature_names = list(df.columns)
+        self.feature_dtypes = df.dtypes
+        self.matrices[cat] = to_matrix(df, self.matrix_dtype)
+        return self.matrices[cat]
+
+    def feature_index(self, columns):
+        return [self.feature_names.index(c) for c in columns]
+
+    def matrix_columns(self, cat, columns, rows=slice(None)):
+        """
+        Columns of a materialized split (restricted to rows) as a dense array
+        """
+        x = self.get_x(cat)[rows][:, self.feature_index(columns)]
+        return x.toarray() if sp.issparse(x) else x
+
+    def set_matrix_columns(self, x, columns, values):
+        """
+        Overwrite columns of a model matrix in place (dense columns are stored explicitly in CSR matrices)
+        """
+        x[:, self.feature_index(columns)] = values
 
     def get_y(self, cat):
+        self.ensure_train_data()
         if cat == "train":
             return self.ytrain.values
         elif cat == "valid":
@@ -67,17 +186,23 @@ class BaseModel:
             raise ValueError("Unknown category '{}'".format(cat))
 
     def eval(self):
+        """
+        Returns the MAE of each evaluated category
+        """
+        scores = dict()
         if self.config["eval_cat"] is not None:
-            full_eval(self, self.config)
+            scores = full_eval(self, self.config)
         if self.config["submit"]:
             self.clean_train_data()
             submit_for_eval(self, self.config)
+        return scores
 
     def init_train_data_base(self):
         config = self.config
         dataset = merge_data(config=config, labeled_only=True)
         if config["additional_features"] is not None:
             dataset = merge_additional_features(dataset, config, "train")
+        memory_report("merge", config)
         if config["data_split_mode"] == "date":
             self.train, self.valid, self.test = split_data_by_date(dataset, config)
         elif config["data_split_mode"] == "random":
@@ -90,22 +215,130 @@ class BaseModel:
         self.xtrain, self.ytrain = get_xy(self.train, config)
         self.xvalid, self.yvalid = get_xy(self.valid, config)
         self.xtest, self.ytest = get_xy(self.test, config)
+        if "transactiondate" in self.xtrain.columns:
+            # split/fold key, not a model feature (a datetime column cannot go in the matrices)
+            self.train_dates = self.xtrain["transactiondate"].values
+            for x in [self.xtrain, self.xvalid, self.xtest]:
+                del x["transactiondate"]
+        self.train_ready = True
+        if not self.keep_frames:
+            for cat in ["train", "valid", "test"]:
+                self.materialize(cat, getattr(self, "x" + cat))
+            self.train = None; self.valid = None; self.test = None
+            self.xtrain = None; self.xvalid = None; self.xtest = None
+            gc.collect()
+        memory_report("train data", config)
+
+    def cv_folds(self):
+        """
+        Row positions of each fold in the train split: contiguous periods when splitting by date, random otherwise
+        """
+        if self.config["data_split_mode"] == "date" and self.train_dates is not None:
+            order = np.argsort(self.train_dates, kind="mergesort")
+        else:
+            if self.config["data_split_mode"] == "date":
+                print("Warning: no transactiondate in the train split, using random folds")
+            order = np.random.RandomState(self.config["random_seed"]).permutation(len(self.ytrain))
+        return np.array_split(order, self.kfold)
+
+    def cross_validate(self):
+        """
+        k-fold cross validation on the train split, folds are trained in cv_jobs threads
+        (the backends release the GIL while fitting), each with nthread // cv_jobs backend threads
+        """
+        print("Cross validation ({} folds)...".format(self.kfold))
+        t = time.time()
+        x = self.get_x("train")
+        y = self.get_y("train")
+        folds = self.cv_folds()
+        jobs = max(1, min(self.cv_jobs, self.kfold))
+        nthread = max(1, self.nthread // jobs)
+        if jobs > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                scores = list(pool.map(lambda i: run_fold(self, x, y, folds, i, nthread), range(self.kfold)))
+        else:
+            scores = [run_fold(self, x, y, folds, i, nthread) for i in range(self.kfold)]
+        for i, (fold, score) in enumerate(zip(folds, scores)):
+            print("fold {}: MAE = {:.7f} ({} rows)".format(i+1, score, len(fold)))
+        print("CV: MAE = {:.7f} +/- {:.7f}".format(np.mean(scores), np.std(scores)))
+        print("Cross validated in {} secs".format(int(time.time() - t)))
+        self.cv_scores = scores
+        return scores
 
     def clean_train_data(self):
-        del self.xtrain; del self.ytrain
-        del self.xvalid; del self.yvalid
-        del self.xtest; del self.ytest
+        self.train = None; self.valid = None; self.test = None
+        for cat in ["train", "valid", "test"]:
+            self.matrices.pop(cat, None)
+        self.train_ready = False
+        self.train_dates = None
+        self.xtrain = None; self.ytrain = None
+        self.xvalid = None; self.yvalid = None
+        self.xtest = None; self.ytest = None
         gc.collect()
 
+    def dataset_cache_path(self, name):
+        """
+        Path of a cached binary dataset, the directory is keyed by everything defining the train/valid/test matrices
+        (data and feature files, features, split, preprocessing) but not by the model params
+        None when disabled (config: dataset_cache = False)
+        """
+        config = self.config
+        if config["dataset_cache"] is False:
+            return None
+        desc = dict((k, v) for k, v in config.default.items() if k in DATASET_KEYS or k.startswith(DATASET_KEY_PREFIXES))
+        desc["sources"] = source_mtimes()
+        feats = config["additional_features"] or []
+        desc["feature_files"] = [os.path.getmtime(os.path.join(constant.FEATURE_FACTORY_TRAIN, f + ".pkl")) for f in feats]
+        key = hashlib.sha1(json.dumps(desc, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(constant.DATASET_CACHE, key, name)
+
     def init_submit_data_base(self, mode):
         config = self.config
         datasubmit = merge_data(config=config, labeled_only=False)
         if config["additional_features"] is not None:
             datasubmit = merge_additional_features(datasubmit, config, mode)
         datasubmit = preprocess(datasubmit, config, self, mode="submit", no_reduction=True)
+        self.matrices.pop("submit", None)
         self.xsubmit = get_x(datasubmit, config)
         self.submitindex = datasubmit.index
+        if "transactiondate" in self.xsubmit.columns:
+            del self.xsubmit["transactiondate"] # not a model feature (see init_train_data_base)
+        if not self.keep_frames:
+            del datasubmit
+            self.materialize("submit", self.xsubmit)
+            self.xsubmit = None
+            gc.collect()
+        memory_report("submit data", config)
+
+    def submit_month_columns(self, mode, rows=slice(None)):
+        """
+        Preprocessed month-dependent additional features of the submit data for mode (test_YYMM)
+        aligned to submitindex[rows], None when all features are month-invariant
+        Only the monthly features are read (one column per feature for the month)
+        """
+        config = self.config
+        features = monthly_features(config)
+        if not features:
+            return None
+        print("Reading monthly features [{}]..".format(mode), end="", flush=True)
+        index = self.submitindex[rows]
+        feats = read_additional_features(features, mode).reindex(index)
+        if config["compact"]:
+            compact_frame(feats)
+        print(". Done.", flush=True)
+        feats = preprocess(feats, config, self, mode="submit", no_reduction=True, features_only=True)
+        inputs = config["polynomialfeatures"]
+        if "polynomialfeatures" in [pp for pp, _ in self.preprocessor.pipeline("submit")] and set(inputs) & set(feats.columns):
+            # polynomial terms of monthly inputs change with the month
+            x = pd.DataFrame(self.matrix_columns("submit", inputs, rows), index=index, columns=inputs)
+            for c in inputs:
+                if c in feats.columns:
+                    x[c] = feats[c].values
+            poly = polynomial_expand(x, config, self.preprocessor.state)
+            feats[list(poly.columns)] = poly.values
+        return feats
 
     def clean_submit_data(self):
-        del self.xsubmit
+        self.xsubmit = None
+        self.matrices.pop("submit", None)
         gc.collect()
@@ -74,6 +74,12 @@ class Config(object):
         else:
             return self.default.get(item, None)
 
+    def __setitem__(self, item, value):
+        if isinstance(item, tuple):
+            self.sections.setdefault(item[0], OrderedDict())[item[1]] = value
+        else:
+            self.default[item] = value
+
     def __contains__(self, item):
         if isinstance(item, tuple):
             section = item[0]
@@ -5,18 +5,28 @@ PROPERTIES_2016 = os.path.expandvars("$ZILLOW/data/properties_2016.csv")
 TRAIN_2016 = os.path.expandvars("$ZILLOW/data/train_2016_v2.csv")
 SAMPLE_SUBMIT = os.path.expandvars("$ZILLOW/data/sample_submission.csv")
 
-# Pickle files
-PROPERTIES_2016_PKL = os.path.expandvars("$ZILLOW/data/properties_2016.pkl")
+# Cache files
+PROPERTIES_2016_CACHE = os.path.expandvars("$ZILLOW/data/properties_2016/")
 TRAIN_2016_PKL = os.path.expandvars("$ZILLOW/data/train_2016_v2.pkl")
+SAMPLE_SUBMIT_INDEX_CACHE = os.path.expandvars("$ZILLOW/data/sample_submission_index/")
+
+# Binary datasets (xgboost DMatrix, lightgbm Dataset) reused between runs
+DATASET_CACHE = os.path.expandvars("$ZILLOW/cache/datasets/")
+
+# In-process dataset cache
+DATASET_CACHE_MAX_BYTES = int(os.environ.get("ZILLOW_DATASET_CACHE_MB", 8192)) * 1024 * 1024
 
 # Feature Factory
 FEATURE_FACTORY_DEFINITIONS = os.path.expandvars("$ZILLOW/features/feature_definitions.txt")
 ORACLE_FACTORY_DEFINITIONS = os.path.expandvars("$ZILLOW/features/oracle_definitions.txt")
 FEATURE_FACTORY_TRAIN = os.path.expandvars("$ZILLOW/features/train/")
+FEATURE_FACTORY_MANIFEST = os.path.expandvars("$ZILLOW/features/manifest.json")
 FEATURE_FACTORY_TEST_1610 = os.path.expandvars("$ZILLOW/features/test/1610")
 FEATURE_FACTORY_TEST_1611 = os.path.expandvars("$ZILLOW/features/test/1611")
 FEATURE_FACTORY_TEST_1612 = os.path.expandvars("$ZILLOW/features/test/1612")
 FEATURE_FACTORY_TEST_1710 = os.path.expandvars("$ZILLOW/features/test/1710")
 FEATURE_FACTORY_TEST_1711 = os.path.expandvars("$ZILLOW/features/test/1711")
 FEATURE_FACTORY_TEST_1712 = os.path.expandvars("$ZILLOW/features/test/1712")
-FEATURE_FACTORY_COMPRESSION = "gzip"
\ No newline at end of file
+FEATURE_FACTORY_TEST_STATIC = os.path.expandvars("$ZILLOW/features/test/static") # month-invariant features
+FEATURE_FACTORY_COMPRESSION = "gzip"
+FEATURE_FACTORY_CODE_SUFFIX = "_code" # categorical features as a single column of integer codes
\ No newline at end of file
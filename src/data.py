@@ -1,85 +1,221 @@
 import os
+import gc
+import json
+import hashlib
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 import constant
+from profiling import timed, peak_memory_mb
 import datetime
 from config import Config
 
 
-def read_properties():
+@timed("read_properties")
+def read_properties(columns=None):
+    """
+    Read properties from the column cache (built from the csv on first use)
+    columns: names of the columns to load (other names are ignored), None for all
+    """
     print("Reading PROPERTIES DATA... ", end="", flush=True)
-    if os.path.exists(constant.PROPERTIES_2016_PKL):
-        df = pd.read_pickle(constant.PROPERTIES_2016_PKL)
-    else:
-        df = pd.read_csv(constant.PROPERTIES_2016,
-            header = 0,
-            index_col = 0,
-            parse_dates = [46,51],
-            infer_datetime_format = True,
-            dtype = { "parcelid": np.int64,
-                    "airconditioningtypeid": np.float64,
-                    "architecturalstyletypeid": str,
-                    "basementsqft": np.float64,
-                    "bathroomcnt": np.float64,
-                    "bedroomcnt": np.float64,
-                    "buildingclasstypeid": str,
-                    "buildingqualitytypeid": str,
-                    "calculatedbathnbr": np.float64,
-                    "decktypeid": str,
-                    "finishedfloor1squarefeet": np.float64,
-                    "calculatedfinishedsquarefeet": np.float64,
-                    "finishedsquarefeet12": np.float64,
-                    "finishedsquarefeet13": np.float64,
-                    "finishedsquarefeet15": np.float64,
-                    "finishedsquarefeet50": np.float64,
-                    "finishedsquarefeet6": np.float64,
-                    "fips": str,
-                    "fireplacecnt": np.float64,
-                    "fullbathcnt": np.float64,
-                    "garagecarcnt": np.float64,
-                    "garagetotalsqft": np.float64,
-                    "hashottuborspa": str,
-                    "heatingorsystemtypeid": str,
-                    "latitude": np.float64,
-                    "longitude": np.float64,
-                    "lotsizesquarefeet": np.float64,
-                    "poolcnt": np.float64,
-                    "poolsizesum": np.float64,
-                    "pooltypeid10": str,
-                    "pooltypeid2": str,
-                    "pooltypeid7": str,
-                    "propertycountylandusecode": str,
-                    "propertylandusetypeid": str,
-                    "propertyzoningdesc": str,
-                    "rawcensustractandblock": str,
-                    "regionidcity": str,
-                    "regionidcounty": str,
-                    "regionidneighborhood": str,
-                    "regionidzip": str,
-                    "roomcnt": np.float64,
-                    "storytypeid": str,
-                    "threequarterbathnbr": np.float64,
-                    "typeconstructiontypeid": str,
-                    "unitcnt": np.float64,
-                    "yardbuildingsqft17": np.float64,
-                    "yardbuildingsqft26": np.float64,
-                    "yearbuilt": str, # date
-                    "numberofstories": np.float64,
-                    "fireplaceflag": str,
-                    "structuretaxvaluedollarcnt": np.float64,
-                    "taxvaluedollarcnt": np.float64,
-                    "assessmentyear": str, # date
-                    "landtaxvaluedollarcnt": np.float64,
-                    "taxamount": np.float64,
-                    "taxdelinquencyflag": str,
-                    "taxdelinquencyyear": str,
-                    "censustractandblock": str}
-            )
-        df.to_pickle(constant.PROPERTIES_2016_PKL)
-        print("Created pickle file: {}".format(constant.PROPERTIES_2016_PKL))
-    _df_properties = df
-    return df.copy()
+    manifest = read_properties_manifest()
+    if manifest is None:
+        df = read_properties_csv()
+        write_properties_cache(df)
+        print("Created column cache: {}".format(constant.PROPERTIES_2016_CACHE))
+        if columns is not None:
+            df = df[[c for c in df.columns if c in set(columns)]]
+        return df
+    return load_properties_cache(manifest, columns)
+
+def read_properties_csv():
+    df = pd.read_csv(constant.PROPERTIES_2016,
+        header = 0,
+        index_col = 0,
+        parse_dates = [46,51],
+        infer_datetime_format = True,
+        dtype = { "parcelid": np.int64,
+                "airconditioningtypeid": np.float64,
+                "architecturalstyletypeid": str,
+                "basementsqft": np.float64,
+                "bathroomcnt": np.float64,
+                "bedroomcnt": np.float64,
+                "buildingclasstypeid": str,
+                "buildingqualitytypeid": str,
+                "calculatedbathnbr": np.float64,
+                "decktypeid": str,
+                "finishedfloor1squarefeet": np.float64,
+                "calculatedfinishedsquarefeet": np.float64,
+                "finishedsquarefeet12": np.float64,
+                "finishedsquarefeet13": np.float64,
+                "finishedsquarefeet15": np.float64,
+                "finishedsquarefeet50": np.float64,
+                "finishedsquarefeet6": np.float64,
+                "fips": str,
+                "fireplacecnt": np.float64,
+                "fullbathcnt": np.float64,
+                "garagecarcnt": np.float64,
+                "garagetotalsqft": np.float64,
+                "hashottuborspa": str,
+                "heatingorsystemtypeid": str,
+                "latitude": np.float64,
+                "longitude": np.float64,
+                "lotsizesquarefeet": np.float64,
+                "poolcnt": np.float64,
+                "poolsizesum": np.float64,
+                "pooltypeid10": str,
+                "pooltypeid2": str,
+                "pooltypeid7": str,
+                "propertycountylandusecode": str,
+                "propertylandusetypeid": str,
+                "propertyzoningdesc": str,
+                "rawcensustractandblock": str,
+                "regionidcity": str,
+                "regionidcounty": str,
+                "regionidneighborhood": str,
+                "regionidzip": str,
+                "roomcnt": np.float64,
+                "storytypeid": str,
+                "threequarterbathnbr": np.float64,
+                "typeconstructiontypeid": str,
+                "unitcnt": np.float64,
+                "yardbuildingsqft17": np.float64,
+                "yardbuildingsqft26": np.float64,
+                "yearbuilt": str, # date
+                "numberofstories": np.float64,
+                "fireplaceflag": str,
+                "structuretaxvaluedollarcnt": np.float64,
+                "taxvaluedollarcnt": np.float64,
+                "assessmentyear": str, # date
+                "landtaxvaluedollarcnt": np.float64,
+                "taxamount": np.float64,
+                "taxdelinquencyflag": str,
+                "taxdelinquencyyear": str,
+                "censustractandblock": str}
+        )
+    return df
+
+def file_fingerprint(path):
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": int(st.st_mtime)}
+
+def read_properties_manifest():
+    path = os.path.join(constant.PROPERTIES_2016_CACHE, "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    source = file_fingerprint(constant.PROPERTIES_2016)
+    if source is not None and source != manifest["source"]:
+        print("column cache is stale... ", end="", flush=True)
+        return None
+    return manifest
+
+def write_properties_cache(df):
+    """
+    One memory-mappable .npy file per column, strings are stored as category codes
+    The manifest is written last so that an interrupted build is never used
+    """
+    path = constant.PROPERTIES_2016_CACHE
+    if not os.path.exists(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, "index.npy"), df.index.values.astype(np.int64))
+    columns = []
+    for c in df.columns:
+        s = df[c]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            kind = "datetime"
+            values = s.values.view(np.int64)
+        elif pd.api.types.is_numeric_dtype(s):
+            kind = "numeric"
+            values = s.values
+        else:
+            kind = "category"
+            cat = pd.Categorical(s)
+            values = cat.codes
+            np.save(os.path.join(path, c + ".categories.npy"), np.asarray(cat.categories, dtype=str))
+        np.save(os.path.join(path, c + ".npy"), values)
+        columns.append({"name": c, "kind": kind, "dtype": str(s.dtype)})
+    manifest = {
+        "source": file_fingerprint(constant.PROPERTIES_2016),
+        "index": df.index.name,
+        "index_checksum": index_checksum(df.index.values),
+        "columns": columns,
+    }
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+def load_properties_cache(manifest, columns=None):
+    path = constant.PROPERTIES_2016_CACHE
+    if columns is not None:
+        columns = set(columns)
+    data = OrderedDict()
+    for col in manifest["columns"]:
+        c = col["name"]
+        if columns is not None and c not in columns:
+            continue
+        values = np.load(os.path.join(path, c + ".npy"), mmap_mode="r")
+        if col["kind"] == "numeric":
+            values = np.array(values)
+        elif col["kind"] == "datetime":
+            values = np.array(values).view(col["dtype"])
+        elif col["kind"] == "category":
+            categories = np.load(os.path.join(path, c + ".categories.npy")).astype(object)
+            values = np.append(categories, np.nan)[values] # code -1 is NaN
+        data[c] = values
+    index = pd.Index(np.load(os.path.join(path, "index.npy")), name=manifest["index"])
+    return pd.DataFrame(data, index=index, columns=list(data.keys()))
 
+def index_checksum(values):
+    """
+    Fingerprint of an ordered parcelid sequence
+    """
+    return hashlib.sha1(np.ascontiguousarray(values, dtype=np.int64).tobytes()).hexdigest()
+
+def properties_index_checksum():
+    """
+    Checksum of the properties index (row order of the submit data), from the column cache manifest
+    """
+    manifest = read_properties_manifest()
+    if manifest is None:
+        read_properties(columns=[])
+        manifest = read_properties_manifest()
+    if "index_checksum" not in manifest:
+        # manifest written before checksums were recorded
+        return index_checksum(np.load(os.path.join(constant.PROPERTIES_2016_CACHE, "index.npy"), mmap_mode="r"))
+    return manifest["index_checksum"]
+
+def read_submit_index():
+    """
+    ParcelIds of the sample submission in file order, with a manifest holding their checksum
+    Cached as int64 .npy, rebuilt when the sample submission file changes
+    """
+    path = constant.SAMPLE_SUBMIT_INDEX_CACHE
+    manifest_path = os.path.join(path, "manifest.json")
+    source = file_fingerprint(constant.SAMPLE_SUBMIT)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["source"] == source:
+            return np.load(os.path.join(path, "index.npy")), manifest
+    index = pd.read_csv(constant.SAMPLE_SUBMIT, usecols=[0], dtype=np.int64).iloc[:, 0].values
+    if not os.path.exists(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, "index.npy"), index)
+    manifest = {
+        "source": source,
+        "size": len(index),
+        "sorted": bool((index[1:] >= index[:-1]).all()),
+        "checksum": index_checksum(index),
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    return index, manifest
+
+@timed("read_train")
 def read_train(drop_duplicates=True):
     print("Reading TRAIN DATA... ", end="", flush=True)
     if os.path.exists(constant.TRAIN_2016_PKL):
@@ -97,13 +233,35 @@ def read_train(drop_duplicates=True):
     _df_train = df
     return df.copy()
 
-def split_data_by_date(df, config):
+def date_window(df, start, end, column="transactiondate"):
+    """
+    Positional indexer of the rows with start <= df[column] < end (missing dates never match)
+    Returns a slice (binary search) when the column is sorted, an array of positions otherwise
+    """
+    dates = df[column]
+    start = np.datetime64(start)
+    end = np.datetime64(end)
+    if dates.is_monotonic_increasing and not dates.hasnans:
+        lo, hi = np.searchsorted(dates.values, [start, end], side="left")
+        return slice(int(lo), int(max(lo, hi)))
+    dates = dates.values
+    return np.flatnonzero((dates >= start) & (dates < end))
+
+def select_date_window(df, start, end, column="transactiondate"):
+    return df.iloc[date_window(df, start, end, column)]
+
+def split_data_by_date(df, config, as_index=False):
+    """
+    as_index: return positional indexers (see date_window) instead of dataframes
+    """
     print("Splitting Data by date... ", end="", flush=True)
-    train = df.loc[df.apply(lambda row: config["train_start"] <= row['transactiondate'] < config["train_end"], axis=1)]
-    valid = df.loc[df.apply(lambda row: config["valid_start"] <= row['transactiondate'] < config["valid_end"], axis=1)]
-    test = df.loc[df.apply(lambda row: config["test_start"] <= row['transactiondate'] < config["test_end"], axis=1)]
+    windows = []
+    for split in ["train", "valid", "test"]:
+        windows.append(date_window(df, config[split + "_start"], config[split + "_end"]))
     print("Done.", flush=True)
-    return train, valid, test
+    if as_index:
+        return tuple(windows)
+    return tuple(df.iloc[w] for w in windows)
 
 def split_data_random(df, config):
     print("Splitting Data at random... ", end="", flush=True)
@@ -118,24 +276,146 @@ def split_data_random(df, config):
     return train, valid, test
 
 def get_xy(dataset, config):
+    """
+    Split dataset in place: the target column is moved out (forbid access to target), x is dataset itself
+    """
     target = config["target"]
-    x = dataset.drop([target], axis=1) # forbid access to target
-    y = dataset[[target]] # usually is "logerror"
-    return x,y
+    y = dataset.pop(target).to_frame() # usually is "logerror"
+    return dataset, y
 
 def get_x(dataset, config):
     target = config["target"]
-    x = dataset.drop([target], axis=1) # forbid access to target
-    return x
+    if target in dataset.columns:
+        del dataset[target] # forbid access to target
+    return dataset
 
-def merge_data(config=None, labeled_only=True):
-    print("Merging data... ", end="", flush=True)
-    df_prop = read_properties()
+def memory_report(stage, config):
+    """
+    Print the peak resident memory of the process after stage (config: memory_report = True)
+    """
+    if config["memory_report"]:
+        print(" [{}: peak {:.0f} MB]".format(stage, peak_memory_mb()), end="", flush=True)
+
+"""
+In-process cache of joined datasets (LRU, bounded by constant.DATASET_CACHE_MAX_BYTES)
+Keyed by (source files mtimes, labeled_only, selected columns), entries are never handed out directly
+Disabled unless enable_dataset_cache() is called (experiment sweeps): a single run would keep its frames twice
+"""
+_dataset_cache = OrderedDict()
+_dataset_cache_enabled = False
+
+def enable_dataset_cache(enabled=True):
+    global _dataset_cache_enabled
+    _dataset_cache_enabled = enabled
+    if not enabled:
+        clear_dataset_cache()
+
+def source_mtimes():
+    paths = [
+        constant.PROPERTIES_2016,
+        os.path.join(constant.PROPERTIES_2016_CACHE, "manifest.json"),
+        constant.TRAIN_2016,
+        constant.TRAIN_2016_PKL,
+    ]
+    return tuple(os.path.getmtime(p) if os.path.exists(p) else None for p in paths)
+
+def clear_dataset_cache():
+    _dataset_cache.clear()
+    gc.collect()
+
+def dataset_cache_size():
+    return sum(nbytes for _, nbytes in _dataset_cache.values())
+
+def get_cached_dataset(key):
+    mtimes, labeled_only, columns = key
+    for k in list(_dataset_cache.keys()):
+        if k[0] != mtimes: # sources changed on disk
+            del _dataset_cache[k]
+    for k, (dataset, _) in _dataset_cache.items():
+        if k[1] != labeled_only:
+            continue
+        # an entry holding more columns than requested can serve the request
+        if k[2] is None or (columns is not None and columns <= k[2]):
+            _dataset_cache.move_to_end(k)
+            return dataset
+    return None
+
+def is_cached(dataset):
+    return any(d is dataset for d, _ in _dataset_cache.values())
+
+def cache_dataset(key, dataset):
+    if not _dataset_cache_enabled:
+        return
+    nbytes = int(dataset.memory_usage(index=True).sum())
+    if nbytes > constant.DATASET_CACHE_MAX_BYTES:
+        return
+    while _dataset_cache and dataset_cache_size() + nbytes > constant.DATASET_CACHE_MAX_BYTES:
+        _dataset_cache.popitem(last=False)
+    _dataset_cache[key] = (dataset, nbytes)
+
+def join_data(columns=None, labeled_only=True):
+    if columns is not None:
+        columns = frozenset(columns)
+    key = (source_mtimes(), labeled_only, columns)
+    dataset = get_cached_dataset(key)
+    if dataset is not None:
+        print("(cached) ", end="", flush=True)
+        return dataset
+    df_prop = read_properties(columns=columns)
     df_train = read_train()
     if labeled_only:
         dataset = df_prop.join(df_train, how="right")
     else:
         dataset = df_prop.join(df_train, how="left")
+    cache_dataset(key, dataset)
+    return dataset
+
+def categorical_columns(columns):
+    """
+    Positions of the categorical code columns (see constant.FEATURE_FACTORY_CODE_SUFFIX)
+    """
+    return [i for i, c in enumerate(columns) if c.endswith(constant.FEATURE_FACTORY_CODE_SUFFIX)]
+
+def to_matrix(df, dtype=None):
+    """
+    Values of df as a C-contiguous numpy array, or as a CSR matrix when df holds sparse columns
+    Dense columns keep explicit zeros in the CSR matrix (an absent entry is 'missing' for xgboost)
+    dtype: common dtype of the matrix (None: numpy's choice for the dense case, float64 for CSR)
+    """
+    is_sparse = [isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes]
+    if not any(is_sparse):
+        if not all(isinstance(t, np.dtype) for t in df.dtypes):
+            return np.ascontiguousarray(df.to_numpy(dtype=dtype))
+        # filled column by column: to_numpy returns the blocks in F order (a second copy to get C order)
+        x = np.empty(df.shape, dtype=dtype or np.result_type(*df.dtypes), order="C")
+        for j in range(df.shape[1]):
+            x[:, j] = df.iloc[:, j].values
+        return x
+    blocks = []
+    start = 0
+    for stop in range(1, len(is_sparse) + 1):
+        if stop < len(is_sparse) and is_sparse[stop] == is_sparse[start]:
+            continue
+        block = df.iloc[:, start:stop]
+        if is_sparse[start]:
+            blocks.append(block.sparse.to_coo().tocsr().astype(dtype or np.float64))
+        else:
+            values = np.ascontiguousarray(block.values, dtype=dtype or np.float64)
+            n, k = values.shape
+            indices = np.tile(np.arange(k, dtype=np.int32), n)
+            indptr = np.arange(0, n * k + 1, k, dtype=np.int64)
+            blocks.append(sp.csr_matrix((values.ravel(), indices, indptr), shape=(n, k)))
+        start = stop
+    return sp.hstack(blocks, format="csr", dtype=dtype or np.float64)
+
+@timed("merge_data")
+def merge_data(config=None, labeled_only=True):
+    print("Merging data... ", end="", flush=True)
+    columns = None
+    if config is not None and config["features"] is not None:
+        columns = config["features"]
+    joined = join_data(columns=columns, labeled_only=labeled_only)
+    dataset = joined
     if config is not None:
         target = config["target"]
         drops = config["drops"]
@@ -157,14 +437,49 @@ def merge_data(config=None, labeled_only=True):
                 raise RuntimeError("Cannot drop target")
             drops = [d for d in drops if d in dataset.columns]
             dataset = dataset.drop(drops, axis=1)
+    if dataset is joined and is_cached(joined):
+        dataset = dataset.copy()
+    if config is not None and config["compact"]:
+        compact_frame(dataset, exclude=[config["target"]])
     print("Done.", flush=True)
     return dataset
 
+def compact_frame(df, exclude=()):
+    """
+    Downcast the columns of df in place: flags to uint8, integer IDs to the smallest integer type
+    (float ID columns without missing values included), other numerics to float32
+    """
+    for c in df.columns:
+        if c in exclude:
+            continue
+        s = df[c]
+        if isinstance(s.dtype, pd.SparseDtype):
+            continue
+        if pd.api.types.is_bool_dtype(s):
+            df[c] = s.values.astype(np.uint8)
+        elif pd.api.types.is_integer_dtype(s):
+            df[c] = pd.to_numeric(s, downcast="integer")
+        elif pd.api.types.is_float_dtype(s):
+            values = s.values
+            if "id" in c and not s.hasnans and (values == np.round(values)).all():
+                df[c] = pd.to_numeric(values.astype(np.int64), downcast="integer")
+            elif s.dtype != np.float32:
+                df[c] = values.astype(np.float32)
+    return df
+
+@timed("merge_additional_features")
 def merge_additional_features(dataset, config, mode):
     print("Merging additional features..", end="", flush=True)
     features = config["additional_features"]
     if features is None:
         raise ValueError("no additional features defined")
+    add_feats = read_additional_features(features, mode)
+    if config["compact"]:
+        compact_frame(add_feats, exclude=[config["target"]])
+    print(". Done.", flush=True)
+    return dataset.join(add_feats, how="left")
+
+def read_additional_features(features, mode):
     mapmode = {
         "train": constant.FEATURE_FACTORY_TRAIN,
         "test_1610": constant.FEATURE_FACTORY_TEST_1610,
@@ -180,11 +495,22 @@ def merge_additional_features(dataset, config, mode):
     dfs = []
     for featname in features:
         print(". {}".format(featname), end="", flush=True)
-        df = pd.read_pickle(os.path.join(path, featname + ".pkl"), compression="gzip")
+        fpath = os.path.join(path, featname + ".pkl")
+        if mode != "train" and not os.path.exists(fpath):
+            # month-invariant features are stored once
+            fpath = os.path.join(constant.FEATURE_FACTORY_TEST_STATIC, featname + ".pkl")
+        df = pd.read_pickle(fpath, compression="gzip")
         dfs.append(df)
-    add_feats = pd.concat(dfs, axis=1)
-    print(". Done.", flush=True)
-    return dataset.join(add_feats, how="left")
+    return pd.concat(dfs, axis=1)
+
+def is_monthly_feature(featname):
+    return not os.path.exists(os.path.join(constant.FEATURE_FACTORY_TEST_STATIC, featname + ".pkl"))
+
+def monthly_features(config):
+    features = config["additional_features"]
+    if features is None:
+        return []
+    return [f for f in features if is_monthly_feature(f)]
 
 
 
@@ -1,13 +1,20 @@
 import os
+import gzip
+import queue
+import threading
 import pandas as pd
 import numpy as np
-from sklearn.metrics import mean_absolute_error, average_precision_score, roc_curve, auc,recall_score,precision_score
-import matplotlib.pyplot as plt
-from stats import plot_error_distribution
+from data import read_submit_index, properties_index_checksum
 import constant
+from profiling import stage, timed
 
 
 def full_eval(model, config):
+    """
+    Print (and plot) the evaluation of each category of eval_cat, returns {category: MAE}
+    """
+    from sklearn.metrics import mean_absolute_error
+    scores = dict()
     for cat in config["eval_cat"]:
         ytrue = model.get_y(cat=cat)
         if not len(ytrue):
@@ -15,6 +22,7 @@ def full_eval(model, config):
             continue
         ypred = model.predict(cat=cat)
         score = mean_absolute_error(ytrue, ypred)
+        scores[cat] = score
         mean_pred = ypred.mean()
         mean_true = ytrue.mean()
         median_pred = np.median(ypred)
@@ -24,13 +32,18 @@ def full_eval(model, config):
         title = "{0}: MAE = {1:.7f}\n pred mean|median|std = {2:.4f}|{3:.4f}|{4:.4f}\n true mean|median|std = {5:.4f}|{6:.4f}|{7:.4f}".format(cat, score, mean_pred, median_pred, std_pred, mean_true, median_true, std_true)
         print(title)
         figname = config["eval_fig"]
+        if figname is None:
+            continue
+        from stats import plot_error_distribution
         fig, ext = os.path.splitext(figname)
         figname = fig + "_" + cat + ext
         plot_error_distribution(ypred, ytrue, title=title, output_fig=figname)
-    return
+    return scores
 
 
 def sign_eval(model, config):
+    from sklearn.metrics import average_precision_score, roc_curve, auc, recall_score, precision_score
+    import matplotlib.pyplot as plt
     for cat in config["eval_cat"]:
         ytrue = model.get_y(cat=cat)
         if not len(ytrue):
@@ -63,21 +76,93 @@ def sign_eval(model, config):
             output_fig = figname + "_" + cat + ext
             fig.savefig(output_fig)
 
+def write_chunks(filename, chunks, errors):
+    """
+    Write the text chunks taken from the queue to a gzip file until None is received
+    An exception is recorded in errors (the thread stops, see put_chunk)
+    """
+    try:
+        with stage("submit_write"), gzip.open(filename, "wt", compresslevel=6) as f:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                f.write(chunk)
+    except BaseException as e:
+        errors.append(e)
+
+def put_chunk(chunks, chunk, writer):
+    """
+    Queue a chunk for the writer thread, False when the writer is gone
+    """
+    while writer.is_alive():
+        try:
+            chunks.put(chunk, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+@timed("submit")
 def submit_for_eval(model, config, cut_output=True):
+    """
+    Stream the predictions to the submission file: parcels are scored for the 6 months chunk by chunk
+    (config: submit_chunk_size) while a writer thread compresses the previous chunks
+    The monthly columns are read and preprocessed once per month, then swapped into each chunk
+    """
     print("Outputting predictions...")
     filename = config["submit_file"]
-    df_sample = pd.read_csv(constant.SAMPLE_SUBMIT, index_col=0, dtype={"ParcelId": np.int64})
-    for month in ["1610", "1611", "1612", "1710", "1711", "1712"]:
-        print("Making predictions for {}.".format(month))
-        model.init_submit_data("test_{}".format(month))
-        if not (model.submitindex == df_sample.index).all():
-            raise ValueError("Submit sample index and model submit index are different for {}!".format(month))
-        ypred = model.predict(cat="submit")
-        df_sample["20" + month] = ypred
-        model.clean_submit_data()
+    # several predict blocks per chunk so that predict_chunked spreads the chunk on the threads
+    chunk_size = config["submit_chunk_size"] or 8 * model.predict_chunk_size
+    months = ["1610", "1611", "1612", "1710", "1711", "1712"]
+    header = pd.read_csv(constant.SAMPLE_SUBMIT, nrows=0).columns
+    # preflight: the submit rows follow the properties index, compare fingerprints before building anything
+    parcelids, sample = read_submit_index()
+    if sample["checksum"] != properties_index_checksum():
+        raise ValueError("Submit sample index and properties index are different!")
+    # static features are built once (with the first month), the other months' columns are swapped in per chunk
+    model.init_submit_data("test_{}".format(months[0]))
+    if len(model.submitindex) != sample["size"]:
+        raise ValueError("Submit sample index and model submit index are different!")
+    x = model.get_x("submit")
+    # (columns, values) of months 2-6, None when no feature changes with the month
+    monthly = [None]
+    for month in months[1:]:
+        feats = model.submit_month_columns("test_{}".format(month))
+        if feats is None:
+            monthly = None
+            break
+        monthly.append((feats.columns, np.asarray(feats.values, dtype=x.dtype)))
+        del feats
+    outputs = [months.index(c[2:]) for c in header[1:]]
+    float_format = "%.4f" if cut_output else None
     print("Writing predictions to {}".format(filename))
-    if cut_output:
-        df_sample.to_csv(filename, float_format='%.4f', compression="gzip")
-    else:
-        df_sample.to_csv(filename, compression="gzip")
+    chunks = queue.Queue(maxsize=2)
+    errors = []
+    writer = threading.Thread(target=write_chunks, args=(filename, chunks, errors))
+    writer.start()
+    try:
+        n = len(parcelids)
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            print("Making predictions for rows {}-{} / {}.".format(start, stop, n))
+            ypred = np.empty((stop - start, len(months)), dtype=np.float64)
+            if monthly is None:
+                ypred[:, :] = model.predict_chunked(x[start:stop]).reshape(-1, 1)
+            else:
+                xchunk = x[start:stop].copy()
+                for i in range(len(months)):
+                    if i > 0:
+                        columns, values = monthly[i]
+                        model.set_matrix_columns(xchunk, columns, values[start:stop])
+                    ypred[:, i] = model.predict_chunked(xchunk).reshape(-1)
+            out = pd.DataFrame(ypred[:, outputs], index=pd.Index(parcelids[start:stop], name=header[0]), columns=header[1:])
+            if not put_chunk(chunks, out.to_csv(header=(start == 0), float_format=float_format), writer):
+                break
+    finally:
+        put_chunk(chunks, None, writer)
+        writer.join()
+    if errors:
+        raise errors[0]
+    model.clean_submit_data()
     return
@@ -1,8 +1,12 @@
 import os, sys
 import gc
 import math
+import json
+import hashlib
+import inspect
 import time
-from collections import defaultdict, Counter
+import multiprocessing
+from functools import partial
 import pandas as pd
 import numpy as np
 from sklearn import preprocessing
@@ -22,23 +26,72 @@ TESTPATHS = [
     (1712, constant.FEATURE_FACTORY_TEST_1712)
 ]
 
+NO_PREV_MONTH = [1601, 1611, 1612, 1701, 1711, 1712] # WARNING: ONLY WHEN WE DON'T HAVE ACCES TO 2017 TRAIN DATA
+
 def prev_month(ym):
-    if ym in [1601, 1611, 1612, 1701, 1711, 1712]: # WARNING: ONLY WHEN WE DON'T HAVE ACCES TO 2017 TRAIN DATA
-        return None
+    """
+    Previous month of an array of yymm months (-1 when not available)
+    """
+    ym = np.asarray(ym)
+    return np.where(np.isin(ym, NO_PREV_MONTH), -1, ym - 1)
+
+def transaction_month(dates):
+    return (dates.dt.year % 100) * 100 + dates.dt.month
+
+def lookback_table(traindf, key, agg, value="logerror"):
+    """
+    Aggregate of 'value' by (key, transaction month) and the average of the in-sample months by key
+    agg: "count" (number of transactions) or any pandas groupby aggregation ("mean", "median", "std", ...)
+    """
+    months = transaction_month(traindf["transactiondate"]).rename("transactionmonth")
+    grouped = traindf[value].groupby([traindf[key], months])
+    if agg == "count":
+        table = grouped.size()
     else:
-        return (ym - 1)
+        table = grouped.agg(agg)
+    months = table.index.get_level_values(1)
+    in_sample = ((1601 <= months) & (months <= 1609)) | ((1701 <= months) & (months <= 1709))
+    average = table[in_sample].groupby(level=0).mean()
+    average = average.reindex(table.index.levels[0]).fillna(0.)
+    return table, average
+
+def lookback_values(table, average, keys, months):
+    values = table.reindex(pd.MultiIndex.from_arrays([keys, months])).values.astype(np.float64)
+    fallback = average.reindex(keys).values.astype(np.float64)
+    return np.where(np.isnan(values), fallback, values)
 
 def write_feats(df, path, featname):
+    os.makedirs(path, exist_ok=True) # factories run concurrently (master_factory jobs)
     fpath = os.path.join(path, featname + ".pkl")
     df.to_pickle(fpath, constant.FEATURE_FACTORY_COMPRESSION)
     print("    Wrote: {}".format(fpath))
+    if path in [p for _, p in TESTPATHS]:
+        # monthly files would be shadowed by a stale static one
+        remove_feats(constant.FEATURE_FACTORY_TEST_STATIC, featname)
+
+def write_static_feats(df, featname):
+    write_feats(df, constant.FEATURE_FACTORY_TEST_STATIC, featname)
+    for m, path in TESTPATHS:
+        remove_feats(path, featname)
+
+def remove_feats(path, featname):
+    fpath = os.path.join(path, featname + ".pkl")
+    if os.path.exists(fpath):
+        os.remove(fpath)
+        print("    Removed: {}".format(fpath))
 
 def read_feats(path, featname):
     fpath = os.path.join(path, featname + ".pkl")
     df = pd.read_pickle(fpath, constant.FEATURE_FACTORY_COMPRESSION)
     return df
 
-def create_one_hot_encoding(featname, alldf, traindf, map_to_cat, raw_featname, to_numeric=True):
+def sparse_feats(values, index, columns):
+    # one-hot columns are mostly zeros: keep them sparse on disk and in memory
+    feats = pd.DataFrame.sparse.from_spmatrix(values.astype(np.uint8), index=index, columns=columns)
+    feats.index.name = index.name
+    return feats
+
+def create_one_hot_encoding(featname, traindf, alldf, map_to_cat, raw_featname, to_numeric=True):
     if to_numeric:
         work_all = pd.to_numeric(alldf[raw_featname]).apply(map_to_cat)
         work_train = pd.to_numeric(traindf[raw_featname]).apply(map_to_cat)
@@ -48,18 +101,35 @@ def create_one_hot_encoding(featname, alldf, traindf, map_to_cat, raw_featname,
     encoder = preprocessing.OneHotEncoder()
     encoder.fit(work_all.values.reshape(-1,1))
     # Generate train features
-    ohe_values = encoder.transform(work_train.values.reshape(-1,1)).toarray()
+    ohe_values = encoder.transform(work_train.values.reshape(-1,1))
     ohe_labels = [featname + "_" + str(i) for i in range(ohe_values.shape[1])]
-    feats = pd.DataFrame(ohe_values, index=traindf.index, columns=ohe_labels)
+    feats = sparse_feats(ohe_values, traindf.index, ohe_labels)
+    write_feats(feats, constant.FEATURE_FACTORY_TRAIN, featname)
+    # Generate test features
+    ohe_values = encoder.transform(work_all.values.reshape(-1,1))
+    feats = sparse_feats(ohe_values, alldf.index, ohe_labels)
+    write_static_feats(feats, featname)
+    # Same categories as a single code column (native categorical for lightgbm)
+    create_categorical_codes(featname + constant.FEATURE_FACTORY_CODE_SUFFIX, traindf, alldf, work_all, work_train)
+
+def create_categorical_codes(featname, traindf, alldf, work_all, work_train):
+    categories = np.unique(work_all.values)
+    dtype = np.int16 if len(categories) <= np.iinfo(np.int16).max else np.int32
+    # Category map: code i stands for categories[i]
+    fpath = os.path.join(constant.FEATURE_FACTORY_TRAIN, featname + ".json")
+    with open(fpath, "w") as f:
+        json.dump({"categories": categories.tolist()}, f)
+    print("    Wrote: {}".format(fpath))
+    # Generate train features
+    codes = np.searchsorted(categories, work_train.values).astype(dtype)
+    feats = pd.DataFrame(codes, index=traindf.index, columns=[featname])
     feats.index.name = traindf.index.name
     write_feats(feats, constant.FEATURE_FACTORY_TRAIN, featname)
     # Generate test features
-    ohe_values = encoder.transform(work_all.values.reshape(-1,1)).toarray()
-    ohe_labels = [featname + "_" + str(i) for i in range(ohe_values.shape[1])]
-    feats = pd.DataFrame(ohe_values, index=alldf.index, columns=ohe_labels)
+    codes = np.searchsorted(categories, work_all.values).astype(dtype)
+    feats = pd.DataFrame(codes, index=alldf.index, columns=[featname])
     feats.index.name = alldf.index.name
-    for m, path in TESTPATHS:
-        write_feats(feats, path, featname)
+    write_static_feats(feats, featname)
 
 def dump_static(featname, alldf, traindf, work_all, work_train):
     # Generate train features
@@ -69,8 +139,7 @@ def dump_static(featname, alldf, traindf, work_all, work_train):
     # Generate test features
     feats = pd.DataFrame(work_all.values, index=alldf.index, columns=[featname])
     feats.index.name = alldf.index.name
-    for m, path in TESTPATHS:
-        write_feats(feats, path, featname)
+    write_static_feats(feats, featname)
 
 def create_log_num(featname, alldf, traindf, work_all, work_train):
     # use log
@@ -82,112 +151,27 @@ def create_log_num(featname, alldf, traindf, work_all, work_train):
 """
 Factories
 """
-def past_month_transactions_in_zipcode(featname, traindf, alldf):
-    distribution = defaultdict(dict)
-    average = dict()
-    workdf = traindf.copy()
-    workdf["transactionmonth"] = workdf["transactiondate"].apply(lambda d: int(d.strftime("%y%m")))
-    for (r, m), s in workdf.groupby(["regionidzip", "transactionmonth"]):
-        distribution[r][m] = len(s)
-    for r in distribution:
-        average[r] = 0
-        ct = 0
-        for m, v in distribution[r].items():
-            if 1601 <= m <= 1609 or 1701 <= m <= 1709:
-                ct += 1
-                average[r] += v
-        average[r] = average[r] / float(ct) if ct else 0.
-    # Generate train features
-    prevtrans = []
-    nanct = 0
-    for i, row in workdf[["regionidzip", "transactionmonth"]].iterrows():
-        prevm = prev_month(int(row["transactionmonth"]))
-        r = row["regionidzip"]
-        if math.isnan(r):
-            prevtrans.append(np.nan)
-            nanct += 1
-        else:
-            r = int(r)
-            prevtrans.append(distribution[r].get(prevm, average[r]))
-    print("    NaN for train: {} / {}".format(nanct, len(workdf)))
-    feats = pd.DataFrame(prevtrans, index=workdf.index, columns=[featname])
-    feats.index.name = workdf.index.name
-    write_feats(feats, constant.FEATURE_FACTORY_TRAIN, featname)
-    # Generate test features
-    nanct = 0
-    for m, path in TESTPATHS:
-        prevtrans = []
-        prevm = prev_month(m)
-        for i, r in alldf["regionidzip"].iteritems():
-            if math.isnan(r):
-                prevtrans.append(np.nan)
-                if m == 1610:
-                    nanct += 1
-            else:
-                if r in distribution:
-                    prevtrans.append(distribution[r].get(prevm, average[r]))
-                else:
-                    prevtrans.append(np.nan)
-                    if m == 1610:
-                        nanct += 1
-        if m == 1610:
-            print("    NaN for test: {} / {}".format(nanct, len(alldf)))
-        feats = pd.DataFrame(prevtrans, index=alldf.index, columns=[featname])
-        feats.index.name = alldf.index.name
-        write_feats(feats, path, featname)
-    return
-
-def past_month_mean_error_in_zipcode(featname, traindf, alldf):
-    distribution = defaultdict(dict)
-    average = dict()
-    workdf = traindf.copy()
-    workdf["transactionmonth"] = workdf["transactiondate"].apply(lambda d: int(d.strftime("%y%m")))
-    for (r, m), s in workdf.groupby(["regionidzip", "transactionmonth"]):
-        distribution[r][m] = s['logerror'].mean()
-    for r in distribution:
-        average[r] = 0
-        ct = 0
-        for m, v in distribution[r].items():
-            if 1601 <= m <= 1609 or 1701 <= m <= 1709:
-                ct += 1
-                average[r] += v
-        average[r] = average[r] / float(ct) if ct else 0.
+def past_month_lookback(featname, traindf, alldf, key="regionidzip", agg="count", value="logerror"):
+    """
+    Aggregate of 'value' over the transactions of the previous month sharing the same 'key'
+    Falls back to the in-sample monthly average of the key when the previous month is unknown or empty
+    NaN when the key is missing or never seen in train
+    """
+    table, average = lookback_table(traindf, key, agg, value)
     # Generate train features
-    prevtrans = []
-    nanct = 0
-    for i, row in workdf[["regionidzip", "transactionmonth"]].iterrows():
-        prevm = prev_month(int(row["transactionmonth"]))
-        r = row["regionidzip"]
-        if math.isnan(r):
-            prevtrans.append(np.nan)
-            nanct += 1
-        else:
-            r = int(r)
-            prevtrans.append(distribution[r].get(prevm, average[r]))
-    print("    NaN for train: {} / {}".format(nanct, len(workdf)))
-    feats = pd.DataFrame(prevtrans, index=workdf.index, columns=[featname])
-    feats.index.name = workdf.index.name
+    months = transaction_month(traindf["transactiondate"]).values
+    values = lookback_values(table, average, traindf[key].values, prev_month(months))
+    print("    NaN for train: {} / {}".format(np.isnan(values).sum(), len(values)))
+    feats = pd.DataFrame(values, index=traindf.index, columns=[featname])
+    feats.index.name = traindf.index.name
     write_feats(feats, constant.FEATURE_FACTORY_TRAIN, featname)
     # Generate test features
-    nanct = 0
     for m, path in TESTPATHS:
-        prevtrans = []
-        prevm = prev_month(m)
-        for i, r in alldf["regionidzip"].iteritems():
-            if math.isnan(r):
-                prevtrans.append(np.nan)
-                if m == 1610:
-                    nanct += 1
-            else:
-                if r in distribution:
-                    prevtrans.append(distribution[r].get(prevm, average[r]))
-                else:
-                    prevtrans.append(np.nan)
-                    if m == 1610:
-                        nanct += 1
+        prevm = prev_month(np.full(len(alldf), m))
+        values = lookback_values(table, average, alldf[key].values, prevm)
         if m == 1610:
-            print("    NaN for test: {} / {}".format(nanct, len(alldf)))
-        feats = pd.DataFrame(prevtrans, index=alldf.index, columns=[featname])
+            print("    NaN for test: {} / {}".format(np.isnan(values).sum(), len(values)))
+        feats = pd.DataFrame(values, index=alldf.index, columns=[featname])
         feats.index.name = alldf.index.name
         write_feats(feats, path, featname)
     return
@@ -441,8 +425,8 @@ def logerror_from_median_absolute(featname, traindf):
 Main routine
 """
 FACTORIES = [
-    ("past_month_nb_trans_zip", past_month_transactions_in_zipcode, "number of transactions in the same zipcode during previous month", "num"),
-    ("past_month_mean_error_zip", past_month_mean_error_in_zipcode, "error mean in the same zipcode during previous month", "num"),
+    ("past_month_nb_trans_zip", partial(past_month_lookback, key="regionidzip", agg="count"), "number of transactions in the same zipcode during previous month", "num"),
+    ("past_month_mean_error_zip", partial(past_month_lookback, key="regionidzip", agg="mean"), "error mean in the same zipcode during previous month", "num"),
     ("time_origin_transaction", time_from_origin_to_transaction, "time (in years) from 20160101 to current transaction date (mid of month for out-of-sample prediction)", "num"),
     ("yard_recorded", yard_recorded, "indicates if yard size is recorded", "num"),
     ("log_tax_value", log_tax_value, "log of 'taxvaluedollarcnt' (better distribution than base value)", "num"),
@@ -475,49 +459,135 @@ ORACLES = [
     ("logerror_from_median_absolute", logerror_from_median_absolute, "absolute value of logerror - its median on all train data", "num"),
 ]
 
-def master_factory():
+def format_runtime(s):
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return "%d:%02d:%02d" % (h, m, s)
+
+def score_feature(featname, feattype, traindf):
+    train_feats = read_feats(constant.FEATURE_FACTORY_TRAIN, featname)
+    if feattype == "num":
+        score = "correlation with log error = {0:.2f} %".format(100*train_feats[featname].corr(traindf["logerror"]))
+    elif feattype == "cat":
+        score = "log error mean/std by cat:"
+        for col in train_feats.columns:
+            mask = pd.Series(np.asarray(train_feats[col]) == 1, index=train_feats.index)
+            mean = traindf["logerror"][mask].mean()
+            std = traindf["logerror"][mask].std()
+            score += " {0:.4f}/{1:.4f}".format(mean, std)
+    else:
+        raise ValueError("Unknown feature type '{}'".format(feattype))
+    return score
+
+# (traindf, alldf) while master_factory runs, forked workers inherit it without copy
+_factory_data = None
+
+def run_factory(i):
+    featname, factory, desc, feattype = FACTORIES[i]
+    traindf, alldf = _factory_data
+    t = time.time()
+    print("FACTORY {}: {}".format(featname, desc), flush=True)
+    factory(featname, traindf, alldf)
+    score = score_feature(featname, feattype, traindf)
+    print("    {}: {}".format(featname, score), flush=True)
+    gc.collect()
+    return score, time.time() - t
+
+def read_manifest():
+    if not os.path.exists(constant.FEATURE_FACTORY_MANIFEST):
+        return dict()
+    with open(constant.FEATURE_FACTORY_MANIFEST) as f:
+        return json.load(f)
+
+def write_manifest(manifest):
+    with open(constant.FEATURE_FACTORY_MANIFEST, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def factory_source(factory):
+    if isinstance(factory, partial):
+        return inspect.getsource(factory.func) + repr(factory.args) + repr(sorted(factory.keywords.items()))
+    return inspect.getsource(factory)
+
+def feature_signature(factory, desc, feattype):
+    return {
+        "source": hashlib.sha1(factory_source(factory).encode("utf-8")).hexdigest(),
+        "desc": desc,
+        "type": feattype,
+        "data": list(source_mtimes()),
+    }
+
+def feature_files_exist(featname):
+    def exists(path):
+        return os.path.exists(os.path.join(path, featname + ".pkl"))
+    if not exists(constant.FEATURE_FACTORY_TRAIN):
+        return False
+    return exists(constant.FEATURE_FACTORY_TEST_STATIC) or all(exists(path) for _, path in TESTPATHS)
+
+def is_up_to_date(manifest, featname, factory, desc, feattype):
+    if featname not in manifest or not feature_files_exist(featname):
+        return False
+    if feattype == "cat" and not feature_files_exist(featname + constant.FEATURE_FACTORY_CODE_SUFFIX):
+        return False
+    return manifest[featname]["signature"] == feature_signature(factory, desc, feattype)
+
+def master_factory(jobs=1, only=None, force=False):
+    """
+    Build the features of FACTORIES which are missing or out-of-date (see manifest)
+    jobs: number of factories run in parallel
+    only: restrict the build to these feature names
+    force: rebuild even up-to-date features
+    """
+    global _factory_data
     print("[FEATURE FACTORY]")
     t0 = time.time()
-    # Load data
-    print("LOADING RAW DATA...")
-    traindf = merge_data(labeled_only=True)
-    alldf  = merge_data(labeled_only=False)
-    print("STARTING MASTER FACTORY...\nUsing compression: {}".format(constant.FEATURE_FACTORY_COMPRESSION))
-    scores = []
-    # Create features
-    for featname, factory, desc, feattype in FACTORIES:
-        t = time.time()
-        print("FACTORY {}: {}".format(featname, desc))
-        factory(featname, traindf, alldf)
-        train_feats = read_feats(constant.FEATURE_FACTORY_TRAIN, featname)
-        if feattype == "num":
-            score = "correlation with log error = {0:.2f} %".format(100*train_feats[featname].corr(traindf["logerror"]))
-        elif feattype == "cat":
-            score = "log error mean/std by cat:"
-            for col in train_feats.columns:
-                mean = traindf["logerror"][train_feats[col] == 1].mean()
-                std = traindf["logerror"][train_feats[col] == 1].std()
-                score += " {0:.4f}/{1:.4f}".format(mean, std)
-        else:
-            raise ValueError("Unknown feature type '{}'".format(feattype))
-        scores.append(score)
-        print("    {}".format(score))
-        del train_feats
-        gc.collect()
-        s = time.time() - t
-        m, s = divmod(s, 60)
-        h, m = divmod(m, 60)
-        total_time = "%d:%02d:%02d" % (h, m, s)
-        print("    RUNTIME = {}".format(total_time))
+    names = [featname for featname, _, _, _ in FACTORIES]
+    if only is not None:
+        unknown = [featname for featname in only if featname not in names]
+        if unknown:
+            raise ValueError("Unknown features {}".format(unknown))
+    manifest = read_manifest()
+    todo = []
+    for i, (featname, factory, desc, feattype) in enumerate(FACTORIES):
+        if only is not None and featname not in only:
+            continue
+        if force or not is_up_to_date(manifest, featname, factory, desc, feattype):
+            todo.append(i)
+    print("{} feature(s) to build: {}".format(len(todo), ", ".join(names[i] for i in todo)))
+    if todo:
+        # Load data
+        print("LOADING RAW DATA...")
+        traindf = merge_data(labeled_only=True)
+        alldf  = merge_data(labeled_only=False)
+        print("STARTING MASTER FACTORY...\nUsing compression: {}\nUsing {} job(s)".format(constant.FEATURE_FACTORY_COMPRESSION, jobs))
+        # Create features
+        _factory_data = (traindf, alldf)
+        try:
+            if jobs > 1:
+                pool = multiprocessing.get_context("fork").Pool(jobs)
+                try:
+                    results = pool.map(run_factory, todo, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [run_factory(i) for i in todo]
+        finally:
+            _factory_data = None
+        print("RUNTIMES:")
+        for i, (score, runtime) in zip(todo, results):
+            featname, factory, desc, feattype = FACTORIES[i]
+            print("    {0}: {1}".format(featname, format_runtime(runtime)))
+            manifest[featname] = {
+                "signature": feature_signature(factory, desc, feattype),
+                "score": score,
+                "runtime": runtime,
+            }
+        write_manifest(manifest)
     # Write feature definitions
     with open(constant.FEATURE_FACTORY_DEFINITIONS, "w") as fdef:
-        defs = "\n".join(["{0} := {1} (type = {2}, {3})".format(featname, desc, ctype, score) for (featname, _, desc, ctype), score in zip(FACTORIES, scores)])
+        defs = "\n".join(["{0} := {1} (type = {2}, {3})".format(featname, desc, ctype, manifest[featname]["score"] if featname in manifest else "not built") for (featname, _, desc, ctype) in FACTORIES])
         fdef.write(defs)
-    s = time.time() - t0
-    m, s = divmod(s, 60)
-    h, m = divmod(m, 60)
-    total_time = "%d:%02d:%02d" % (h, m, s)
-    print("\nTOTAL RUNTIME = {}".format(total_time))
+    print("\nTOTAL RUNTIME = {}".format(format_runtime(time.time() - t0)))
 
 def master_oracle():
     print("[ORACLE FACTORY]")
@@ -531,22 +601,24 @@ def master_oracle():
         t = time.time()
         print("ORACLE {}: {}".format(featname, desc))
         factory(featname, traindf)
-        s = time.time() - t
-        m, s = divmod(s, 60)
-        h, m = divmod(m, 60)
-        total_time = "%d:%02d:%02d" % (h, m, s)
-        print("    RUNTIME = {}".format(total_time))
+        print("    RUNTIME = {}".format(format_runtime(time.time() - t)))
     # Write feature definitions
     with open(constant.ORACLE_FACTORY_DEFINITIONS, "w") as fdef:
         defs = "\n".join(["{0} := {1} (type = {2})".format(featname, desc, ctype) for (featname, _, desc, ctype) in ORACLES])
         fdef.write(defs)
-    s = time.time() - t0
-    m, s = divmod(s, 60)
-    h, m = divmod(m, 60)
-    total_time = "%d:%02d:%02d" % (h, m, s)
-    print("\nTOTAL RUNTIME = {}".format(total_time))
+    print("\nTOTAL RUNTIME = {}".format(format_runtime(time.time() - t0)))
 
 
 if __name__ == "__main__":
-#    master_factory()
-    master_oracle()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Build additional features")
+    parser.add_argument("--mode", choices=["factory", "oracle"], default="oracle")
+    parser.add_argument("--jobs", type=int, default=1, help="number of factories run in parallel")
+    parser.add_argument("--only", default=None, help="comma separated feature names to consider")
+    parser.add_argument("--force", action="store_true", help="rebuild up-to-date features")
+    args = parser.parse_args()
+    if args.mode == "factory":
+        only = None if args.only is None else [f.strip() for f in args.only.split(",")]
+        master_factory(jobs=args.jobs, only=only, force=args.force)
+    else:
+        master_oracle()
\ No newline at end of file
@@ -5,12 +5,15 @@ from basemodel import BaseModel
 from data import *
 from preprocessing import preprocess
 
+MODEL_NAMES = ["baseline"]
+
 
 class Model(BaseModel):
     def __init__(self, config):
         super(Model, self).__init__(config)
         self.model = None
         self.baseline = config["baseline"]
+        self.keep_frames = True # predicts from the frames
 
     def init_train_data(self):
         super(Model, self).init_train_data_base()
@@ -23,13 +26,12 @@ class Model(BaseModel):
         self.init_train_data()
         print("Computing baseline...")
         t = time.time()
+        target = self.ytrain[self.config["target"]]
         if self.baseline == "mean":
-            self.mean = self.train["logerror"].mean()
+            self.mean = target.mean()
         elif self.baseline == "mean_city":
-            self.mean = self.train["logerror"].mean()
-            self.mean_city = dict()
-            for city, df in self.train.groupby("regionidcity"):
-                self.mean_city[city] = df["logerror"].mean()
+            self.mean = target.mean()
+            self.mean_city = target.groupby(self.xtrain["regionidcity"]).mean().to_dict()
         else:
             raise ValueError("Unknown baseline '{}'".format(self.baseline))
         total_time = int(time.time() - t)
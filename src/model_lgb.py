@@ -1,6 +1,44 @@
+import os
 import time
+import numpy as np
+import scipy.sparse as sp
 import lightgbm as lgb
 from basemodel import BaseModel
+from data import categorical_columns
+from profiling import stage
+
+MODEL_NAMES = ["lgb"]
+
+
+def matrix_paths(model, cat):
+    """
+    Cached model matrix (.npy, .npz for CSR) and target of a split, next to the binary datasets
+    """
+    x = model.dataset_cache_path(cat + ".x.npy")
+    if x is not None and not os.path.exists(x) and os.path.exists(x[:-1] + "z"):
+        x = x[:-1] + "z"
+    return x, model.dataset_cache_path(cat + ".y.npy")
+
+def load_matrices(model):
+    """
+    {cat: (x, y)} of train/valid/test from the dataset cache (None on cache miss), dense x are memory-mapped
+    """
+    paths = dict((cat, matrix_paths(model, cat)) for cat in ["train", "valid", "test"])
+    if any(path is None or not os.path.exists(path) for xy in paths.values() for path in xy):
+        return None
+    matrices = dict()
+    for cat, (x, y) in paths.items():
+        matrices[cat] = (sp.load_npz(x) if x.endswith(".npz") else np.load(x, mmap_mode="r"), np.load(y))
+    return matrices
+
+def save_matrices(model):
+    for cat in ["train", "valid", "test"]:
+        x, y = matrix_paths(model, cat)
+        if sp.issparse(model.get_x(cat)):
+            sp.save_npz(x[:-1] + "z", model.get_x(cat))
+        else:
+            np.save(x, model.get_x(cat))
+        np.save(y, model.get_y(cat))
 
 
 class Model(BaseModel):
@@ -19,8 +57,10 @@ class Model(BaseModel):
                 "num_leaves": config["num_leaves"],
                 "min_data": config["min_data"],
                 "min_hessian": config["min_hessian"],
+                "num_threads": self.nthread,
             }
         self.num_boost_round = config["num_boost_round"]
+        self.cached = None # {cat: (x, y)} loaded from the dataset cache
         self.early_stopping_round = config["early_stopping_round"]
 
     def init_train_data(self):
@@ -30,25 +70,70 @@ class Model(BaseModel):
         super(Model, self).init_submit_data_base(mode)
 
     def train(self):
-        print("Initializing train data...")
-        self.init_train_data()
+        paths = dict((cat, None if self.kfold else self.dataset_cache_path("{}.max_bin{}.bin".format(cat, self.settings["max_bin"]))) for cat in ["train", "valid"])
+        if all(path is not None and os.path.exists(path) for path in paths.values()):
+            self.cached = load_matrices(self)
+        if self.cached is not None:
+            print("Loading cached lightgbm datasets from {}".format(os.path.dirname(paths["train"])))
+            lgb_train = lgb.Dataset(paths["train"])
+            lgb_valid = lgb.Dataset(paths["valid"], reference=lgb_train)
+            self.load_preprocessing(self.dataset_cache_path("preprocessing.json"))
+        else:
+            print("Initializing train data...")
+            self.init_train_data()
+            if self.kfold:
+                self.cross_validate()
+            categorical = categorical_columns(self.feature_names)
+            if categorical:
+                print("Categorical features: {}".format(", ".join(self.feature_names[i] for i in categorical)))
+            lgb_train = lgb.Dataset(self.get_x("train"), self.get_y("train").reshape(len(self.ytrain)), categorical_feature=categorical, params={"max_bin": self.settings["max_bin"]}, free_raw_data=False)
+            lgb_valid = lgb.Dataset(self.get_x("valid"), self.get_y("valid").reshape(len(self.yvalid)), categorical_feature=categorical, reference=lgb_train, free_raw_data=False)
+            if paths["train"] is not None:
+                if not os.path.exists(os.path.dirname(paths["train"])):
+                    os.makedirs(os.path.dirname(paths["train"]))
+                lgb_train.construct().save_binary(paths["train"])
+                lgb_valid.construct().save_binary(paths["valid"])
+                save_matrices(self)
+                self.save_preprocessing(self.dataset_cache_path("preprocessing.json"))
+                print("Cached lightgbm datasets in {}".format(os.path.dirname(paths["train"])))
+        with stage("lgb_dataset"):
+            lgb_train.construct()
+            lgb_valid.construct()
         print("Start model fitting...")
         t = time.time()
-        lgb_train = lgb.Dataset(self.xtrain.values, self.ytrain.values.reshape(len(self.ytrain)))
-        lgb_valid = lgb.Dataset(self.xvalid.values, self.yvalid.values.reshape(len(self.yvalid)), reference=lgb_train)
         self.model = lgb.train(self.settings, lgb_train, self.num_boost_round, [lgb_valid])
         total_time = int(time.time() - t)
-        self.model.reset_parameter({"num_threads":1})
         print("Trained model in {} secs".format(total_time))
 
+    def get_x(self, cat):
+        if not self.train_ready and self.cached is not None and cat in self.cached:
+            return self.cached[cat][0]
+        return super(Model, self).get_x(cat)
+
+    def get_y(self, cat):
+        if not self.train_ready and self.cached is not None and cat in self.cached:
+            return self.cached[cat][1]
+        return super(Model, self).get_y(cat)
+
+    def fit_fold(self, xtrain, ytrain, xvalid, yvalid, nthread):
+        categorical = categorical_columns(self.feature_names)
+        lgb_train = lgb.Dataset(xtrain, ytrain.reshape(len(ytrain)), categorical_feature=categorical)
+        lgb_valid = lgb.Dataset(xvalid, yvalid.reshape(len(yvalid)), categorical_feature=categorical, reference=lgb_train)
+        return lgb.train(dict(self.settings, num_threads=nthread), lgb_train, self.num_boost_round, [lgb_valid])
+
     def save(self):
         self.model.save_model(self.params)
+        self.save_preprocessing()
         print("Saved model at: {}".format(self.params))
 
     def load(self):
         self.model = lgb.Booster(model_file=self.params)
         print("Loaded model from: {}".format(self.params))
+        self.load_preprocessing()
 
-    def predict_from_x(self, x):
-        pred = self.model.predict(x)
+    def predict_from_x(self, x, nthread=None):
+        if nthread is not None:
+            pred = self.model.predict(x, num_threads=nthread)
+        else:
+            pred = self.model.predict(x)
         return pred
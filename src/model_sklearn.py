@@ -3,12 +3,16 @@ from basemodel import BaseModel
 from preprocessing import preprocess
 from data import *
 from sklearn import ensemble
+from sklearn.base import clone
 import numpy as np
 from sklearn import metrics, datasets
 from sklearn import datasets, linear_model
 from sklearn.externals import joblib
 from sklearn.svm import SVR
 
+MODEL_NAMES = ["sklearn_linear_regression", "sklearn_ridge", "sklearn_ridgecv", "sklearn_lasso", "sklearn_lassolars",
+    "sklearn_bayesianridge", "sklearn_randomforest", "sklearn_svr"]
+
 class Model(BaseModel):
     def __init__(self, config):
         super(Model, self).__init__(config)
@@ -51,20 +55,32 @@ class Model(BaseModel):
     def train(self):
         print("Initializing train data...")
         self.init_train_data()
+        if self.kfold:
+            self.cross_validate()
         print("Start model fitting...")
         t = time.time()
-        self.model.fit(self.xtrain.values, self.ytrain.values)
+        self.model.fit(self.get_x("train"), self.get_y("train"))
         total_time = int(time.time() - t)
         print("Trained model in {} secs".format(total_time))
 
+    def fit_fold(self, xtrain, ytrain, xvalid, yvalid, nthread):
+        model = clone(self.model)
+        if "n_jobs" in model.get_params():
+            model.set_params(n_jobs=nthread)
+        model.fit(xtrain, ytrain)
+        return model
+
     def save(self):
         joblib.dump(self.model, self.params)
+        self.save_preprocessing()
         print("Saved model at: {}".format(self.params))
 
     def load(self):
         self.model = joblib.load(self.params)
         print("Loaded model from: {}".format(self.params))
+        self.load_preprocessing()
 
-    def predict_from_x(self, x):
+    def predict_from_x(self, x, nthread=None):
+        # estimators with n_jobs get their own pool, the others are parallel across predict_chunked blocks
         pred = self.model.predict(x)
         return pred
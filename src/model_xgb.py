@@ -1,14 +1,84 @@
+import os
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import xgboost as xgb
-import scipy.stats as st
 from sklearn.model_selection import ParameterGrid, ParameterSampler
 from basemodel import BaseModel
+from profiling import timed
 
+MODEL_NAMES = ["xgb"]
 
-class Model(BaseModel):
+
+@timed("dmatrix_cached")
+def load_dmatrices(model):
+    """
+    train/valid/test DMatrix from the binary dataset cache (None on cache miss)
+    """
+    paths = dict((cat, model.dataset_cache_path(cat + ".buffer")) for cat in ["train", "valid", "test"])
+    if any(path is None or not os.path.exists(path) for path in paths.values()):
+        return None
+    print("Loading cached DMatrix from {}".format(os.path.dirname(paths["train"])))
+    model.load_preprocessing(model.dataset_cache_path("preprocessing.json"))
+    return dict((cat, xgb.DMatrix(path)) for cat, path in paths.items())
+
+@timed("dmatrix")
+def build_dmatrices(model):
+    dmatrices = dict()
+    for cat in ["train", "valid", "test"]:
+        dmatrices[cat] = xgb.DMatrix(model.get_x(cat), label=model.get_y(cat))
+        path = model.dataset_cache_path(cat + ".buffer")
+        if path is not None:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            dmatrices[cat].save_binary(path)
+    if path is not None:
+        model.save_preprocessing(model.dataset_cache_path("preprocessing.json"))
+        print("Cached DMatrix in {}".format(os.path.dirname(path)))
+    return dmatrices
+
+def predict_booster(model, x, nthread=None):
+    """
+    Predict x with model.model (a Booster) using nthread threads, shared by the xgboost models
+    """
+    if nthread is not None and model.predict_nthread != (model.model, nthread):
+        # booster-wide setting: the first (serial) block of predict_chunked sets it
+        model.model.set_param("nthread", nthread)
+        model.predict_nthread = (model.model, nthread)
+    xbg_data = xgb.DMatrix(x, nthread=nthread or -1)
+    return model.model.predict(xbg_data)
+
+class BoosterModel(BaseModel):
+    """
+    Common part of the xgboost models: train/valid/test DMatrix (possibly loaded from the dataset cache)
+    serve get_y and predict as long as the frames are not loaded
+    """
     def __init__(self, config):
-        super(Model, self).__init__(config)
+        super(BoosterModel, self).__init__(config)
         self.model = None
+        self.predict_nthread = None
+        self.dmatrices = None
+
+    def get_y(self, cat):
+        if not self.train_ready and self.dmatrices is not None and cat in self.dmatrices:
+            return self.dmatrices[cat].get_label().reshape(-1, 1)
+        return super(BoosterModel, self).get_y(cat)
+
+    def predict(self, cat):
+        if not self.train_ready and self.dmatrices is not None and cat in self.dmatrices:
+            return self.model.predict(self.dmatrices[cat])
+        return super(BoosterModel, self).predict(cat)
+
+    def predict_from_x(self, x, nthread=None):
+        return predict_booster(self, x, nthread)
+
+def trial_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+class Model(BoosterModel):
+    def __init__(self, config):
+        super(Model, self).__init__(config)
         self.training_mode = config["training_mode"]
         if self.training_mode == "base":
             self.settings = {
@@ -17,10 +87,11 @@ class Model(BaseModel):
                     "eta": config["eta"],
                     "max_depth": 4,
                     "silent": 1,
+                    "nthread": self.nthread,
                 }
             self.num_round = config["num_round"]
             self.early_stopping_rounds = config["early_stopping_rounds"]
-        elif self.training_mode == "grid":
+        elif self.training_mode in ["grid", "random"]:
             self.settings = {
                     "objective": config["objective"],
                     "booster": config["booster"],
@@ -33,11 +104,13 @@ class Model(BaseModel):
             self.eval_metric = config["eval_metric"]
             self.n_iter_search = config["n_iter_search"]
             self.random_seed = config["random_seed"]
-            self.kfold = config["kfold"]
             self.num_round = config["num_round"]
             self.early_stopping_rounds = config["early_stopping_rounds"]
-        elif self.training_mode == "random":
-            raise NotImplementedError
+            self.grid_jobs = config["grid_jobs"] or 1
+            self.trial_log = config["trial_log"]
+            self.search_mode = config["search_mode"] or "random"
+            self.halving_factor = config["halving_factor"] or 3
+            self.halving_min_round = config["halving_min_round"] or max(1, self.num_round // self.halving_factor**3)
         else:
             raise ValueError("unknown training mode '{}'".format(self.training_mode))
 
@@ -48,8 +121,14 @@ class Model(BaseModel):
         super(Model, self).init_submit_data_base(mode)
 
     def train(self):
-        print("Initializing train data...")
-        self.init_train_data()
+        cv = self.kfold and self.training_mode == "base"
+        self.dmatrices = None if cv else load_dmatrices(self)
+        if self.dmatrices is None:
+            print("Initializing train data...")
+            self.init_train_data()
+            if cv:
+                self.cross_validate()
+            self.dmatrices = build_dmatrices(self)
         if self.training_mode == "base":
             self.train_base()
         elif self.training_mode == "grid":
@@ -62,47 +141,127 @@ class Model(BaseModel):
     def train_base(self):
         print("Start model fitting...")
         t = time.time()
-        xgb_train = xgb.DMatrix(self.xtrain.values, label=self.ytrain.values)
-        xgb_valid = xgb.DMatrix(self.xvalid.values, label=self.yvalid.values)
+        xgb_train = self.dmatrices["train"]
+        xgb_valid = self.dmatrices["valid"]
         watchlist = [(xgb_train, "train"), (xgb_valid, "valid")]
         self.model = xgb.train(self.settings, xgb_train, self.num_round, watchlist, early_stopping_rounds=self.early_stopping_rounds, verbose_eval=10)
         total_time = int(time.time() - t)
         print("Trained model in {} secs".format(total_time))
 
+    def fit_fold(self, xtrain, ytrain, xvalid, yvalid, nthread):
+        xgb_train = xgb.DMatrix(xtrain, label=ytrain)
+        xgb_valid = xgb.DMatrix(xvalid, label=yvalid)
+        watchlist = [(xgb_train, "train"), (xgb_valid, "valid")]
+        return xgb.train(dict(self.settings, nthread=nthread), xgb_train, self.num_round, watchlist, early_stopping_rounds=self.early_stopping_rounds, verbose_eval=False)
+
     def train_grid(self):
         print("Start model fitting in cross validation (grid mode)...")
         t = time.time()
-        xgb_train = xgb.DMatrix(self.xtrain.values, label=self.ytrain.values)
-        xgb_valid = xgb.DMatrix(self.xvalid.values, label=self.yvalid.values)
+        xgb_train = self.dmatrices["train"]
+        xgb_valid = self.dmatrices["valid"]
         watchlist = [(xgb_train, "train"), (xgb_valid, "valid")]
-        current_best = None
-        param_grid = ParameterGrid(self.settings)
-        for i, params in enumerate(param_grid):
-            print("Testing the following params ({}/{}): {}".format(i+1, len(param_grid), params))
-            eval_res = dict()
-            booster = xgb.train(params, xgb_train, self.num_round, watchlist, early_stopping_rounds=self.early_stopping_rounds, evals_result=eval_res, verbose_eval=10)
-            loss = eval_res["valid"]["mae"][booster.best_iteration]
-            if current_best is None or loss < current_best:
-                current_best = loss
-                self.model = booster
+        self.run_trials(list(ParameterGrid(self.settings)), xgb_train, watchlist)
         total_time = int(time.time() - t)
         print("Trained model in {} secs".format(total_time))
 
+    def read_trial_log(self):
+        trials = dict()
+        if self.trial_log is not None and os.path.exists(self.trial_log):
+            with open(self.trial_log) as f:
+                for line in f:
+                    trial = json.loads(line)
+                    trials[trial_key(trial["params"])] = trial
+        return trials
+
+    def run_trials(self, param_list, xgb_train, watchlist):
+        """
+        Train one booster per params (grid_jobs at a time, sharing the DMatrix) and keep the best one
+        Trials already in trial_log are not trained again
+        """
+        logged = self.read_trial_log()
+        todo = [params for params in param_list if trial_key(params) not in logged]
+        print("{} trials, {} already in trial log".format(len(param_list), len(param_list) - len(todo)))
+        jobs = max(1, min(self.grid_jobs, len(todo)))
+        nthread = max(1, self.nthread // jobs)
+        def run_trial(params):
+            eval_res = dict()
+            booster = xgb.train(dict(params, nthread=nthread), xgb_train, self.num_round, watchlist, early_stopping_rounds=self.early_stopping_rounds, evals_result=eval_res, verbose_eval=10 if jobs == 1 else False)
+            return booster, eval_res["valid"]["mae"][booster.best_iteration]
+        best_loss, best_params, best_booster = None, None, None
+        for params in param_list:
+            trial = logged.get(trial_key(params))
+            if trial is not None and (best_loss is None or trial["loss"] < best_loss):
+                best_loss, best_params = trial["loss"], params
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = dict((executor.submit(run_trial, params), params) for params in todo)
+            for i, future in enumerate(as_completed(futures)):
+                params = futures[future]
+                booster, loss = future.result()
+                print("Trial ({}/{}) loss = {:.6f}: {}".format(i+1, len(todo), loss, params), flush=True)
+                if self.trial_log is not None:
+                    with open(self.trial_log, "a") as f:
+                        f.write(json.dumps({"params": params, "loss": loss, "best_iteration": booster.best_iteration}) + "\n")
+                if best_loss is None or loss < best_loss:
+                    best_loss, best_params, best_booster = loss, params, booster
+        if best_booster is None:
+            # the best trial comes from a previous run
+            print("Retraining best trial from trial log...")
+            best_booster, _ = run_trial(best_params)
+        self.model = best_booster
+        print("Best loss = {:.6f}: {}".format(best_loss, best_params))
+
     def train_random(self):
         print("Start model fitting in cross validation (random mode)...")
-        #TODO
-        raise NotImplementedError
+        t = time.time()
+        xgb_train = self.dmatrices["train"]
+        xgb_valid = self.dmatrices["valid"]
+        watchlist = [(xgb_train, "train"), (xgb_valid, "valid")]
+        param_list = list(ParameterSampler(self.settings, n_iter=self.n_iter_search, random_state=self.random_seed))
+        if self.search_mode == "halving":
+            self.successive_halving(param_list, xgb_train, watchlist)
+        elif self.search_mode == "random":
+            self.run_trials(param_list, xgb_train, watchlist)
+        else:
+            raise ValueError("unknown search mode '{}'".format(self.search_mode))
+        total_time = int(time.time() - t)
         print("Trained model in {} secs".format(total_time))
 
+    def successive_halving(self, param_list, xgb_train, watchlist):
+        """
+        Train every params for halving_min_round rounds, keep the best 1/halving_factor on the valid mae,
+        continue the survivors for halving_factor times more rounds, and so on up to num_round
+        """
+        trials = [{"params": params, "booster": None, "rounds": 0, "losses": []} for params in param_list]
+        used_rounds = 0
+        rounds = self.halving_min_round
+        while True:
+            rounds = min(rounds, self.num_round)
+            jobs = max(1, min(self.grid_jobs, len(trials)))
+            nthread = max(1, self.nthread // jobs)
+            def advance(trial):
+                eval_res = dict()
+                trial["booster"] = xgb.train(dict(trial["params"], nthread=nthread), xgb_train, rounds - trial["rounds"], watchlist, evals_result=eval_res, xgb_model=trial["booster"], verbose_eval=False)
+                trial["losses"].extend(eval_res["valid"]["mae"])
+                new_rounds = rounds - trial["rounds"]
+                trial["rounds"] = rounds
+                return new_rounds
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                used_rounds += sum(executor.map(advance, trials))
+            trials.sort(key=lambda trial: min(trial["losses"]))
+            print("{} trials at {} rounds, best loss = {:.6f}: {}".format(len(trials), rounds, min(trials[0]["losses"]), trials[0]["params"]), flush=True)
+            if rounds >= self.num_round:
+                break
+            trials = trials[:max(1, len(trials) // self.halving_factor)]
+            rounds = self.num_round if len(trials) == 1 else rounds * self.halving_factor
+        self.model = trials[0]["booster"]
+        print("Used {} boosting rounds ({} for a full search)".format(used_rounds, len(param_list) * self.num_round))
+
     def save(self):
         self.model.save_model(self.params)
+        self.save_preprocessing()
         print("Saved model at: {}".format(self.params))
 
     def load(self):
         self.model = xgb.Booster(model_file=self.params)
         print("Loaded model from: {}".format(self.params))
-
-    def predict_from_x(self, x):
-        xbg_data = xgb.DMatrix(x)
-        pred = self.model.predict(xbg_data)
-        return pred
+        self.load_preprocessing()
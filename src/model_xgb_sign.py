@@ -1,20 +1,22 @@
 import time
 import xgboost as xgb
-from basemodel import BaseModel
+from model_xgb import BoosterModel, load_dmatrices, build_dmatrices
 from preprocessing import preprocess
 from data import *
 from eval import sign_eval
 
-class Model(BaseModel):
+MODEL_NAMES = ["xgb_sign"]
+
+class Model(BoosterModel):
     def __init__(self, config):
         super(Model, self).__init__(config)
-        self.model = None
         self.settings = {}
         self.settings["eta"] = config["eta"]
         self.settings["objective"] = config["objective"]
         self.settings["eval_metric"] = config["eval_metric"]
         self.settings["max_depth"] = 4
         self.settings["silent"] = 1
+        self.settings["nthread"] = self.nthread
         self.num_round = config["num_round"]
         self.early_stopping_rounds = config["early_stopping_rounds"]
 
@@ -22,12 +24,15 @@ class Model(BaseModel):
         super(Model, self).init_train_data_base()
 
     def train(self):
-        print("Initializing train data...")
-        self.init_train_data()
+        self.dmatrices = load_dmatrices(self)
+        if self.dmatrices is None:
+            print("Initializing train data...")
+            self.init_train_data()
+            self.dmatrices = build_dmatrices(self)
         print("Start model fitting...")
         t = time.time()
-        xgb_train = xgb.DMatrix(self.xtrain.values, label=self.ytrain.values)
-        xgb_valid = xgb.DMatrix(self.xvalid.values, label=self.yvalid.values)
+        xgb_train = self.dmatrices["train"]
+        xgb_valid = self.dmatrices["valid"]
         watchlist = [(xgb_train, "train"), (xgb_valid, "valid")]
         self.model = xgb.train(self.settings, xgb_train, self.num_round, watchlist, early_stopping_rounds=self.early_stopping_rounds, verbose_eval=10)
         total_time = int(time.time() - t)
@@ -35,16 +40,13 @@ class Model(BaseModel):
 
     def save(self):
         self.model.save_model(self.params)
+        self.save_preprocessing()
         print("Saved model at: {}".format(self.params))
 
     def load(self):
         self.model = xgb.Booster(model_file=self.params)
         print("Loaded model from: {}".format(self.params))
-
-    def predict_from_x(self, x):
-        xbg_data = xgb.DMatrix(x)
-        pred = self.model.predict(xbg_data)
-        return pred
+        self.load_preprocessing()
 
     def eval(self):
         if self.config["eval_cat"] is not None:
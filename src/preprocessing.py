@@ -1,100 +1,179 @@
+import os
+import json
 import numpy as np
-from sklearn import preprocessing
 import pandas as pd
+from data import memory_report
+from profiling import stage
 
-def preprocess(df, config, model=None, mode=None, no_reduction=False):
+TARGET_MODULES = ["target_demean", "target_sign", "target_winsorize", "target_bound", "target_remove_outliers"]
+
+
+class Preprocessor(object):
+    """
+    Preprocessing pipelines compiled from the config's preprocessing_<mode> lists
+    Statistics (target mean, winsor quantiles) are fitted once, on the first train run, and stored in state
+    for the other splits and submission months (state can be saved along with the model)
+    """
+    def __init__(self, config):
+        self.config = config
+        self.state = dict()
+        self.fitted = False
+        self.pipelines = dict()
+
+    def pipeline(self, mode):
+        if mode not in self.pipelines:
+            key = "preprocessing" if mode is None else "preprocessing_{}".format(mode)
+            pplist = self.config[key]
+            if pplist is None and mode is not None:
+                raise ValueError("missing preprocessing for '{}' (add entry: '{}')".format(mode, key))
+            if not isinstance(pplist, list):
+                pplist = [pplist]
+            for pp in pplist:
+                if pp not in MODULES:
+                    raise ValueError("Unknown preprocessing module '{}'".format(pp))
+            self.pipelines[mode] = [(pp, MODULES[pp]) for pp in pplist]
+        return self.pipelines[mode]
+
+    def run(self, df, mode=None, model=None, no_reduction=False, features_only=False):
+        fitting = mode == "train" and not features_only and not self.fitted
+        for pp, module in self.pipeline(mode):
+            if features_only and pp in TARGET_MODULES:
+                continue
+            with stage(pp):
+                if fitting and pp in FITTERS:
+                    FITTERS[pp](df, self.config, self.state)
+                df = module(df, self.config, model, self.state, no_reduction)
+            memory_report(pp, self.config)
+        if fitting:
+            self.fitted = True
+        return df
+
+    def needs_state(self, mode):
+        """
+        True if the pipeline of mode uses statistics fitted on the train data
+        """
+        key = "preprocessing" if mode is None else "preprocessing_{}".format(mode)
+        return self.config[key] is not None and any(pp in FITTERS for pp, _ in self.pipeline(mode))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.state, f, indent=1)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            self.state = json.load(f)
+        self.fitted = True
+        return True
+
+
+def preprocess(df, config, model=None, mode=None, no_reduction=False, features_only=False):
     """
     Preprocess pipe
     df: input pandas dataframe
-    config: config object with field 'preprocessing' (list of str)
-    model: model calling preprocessing (can add attributes to the model)
+    config: config object with field 'preprocessing_<mode>' (list of str)
+    model: model calling preprocessing, its preprocessor keeps the fitted statistics (can add attributes to the model)
     no_reduction: don't change length of dataframe (modules can be ignored)
+    features_only: df holds feature columns only (modules working on the target are ignored)
     """
     print("Preprocessing [{}]..".format(mode), end="", flush=True)
-    if mode == None:
-        pplist = config["preprocessing"]
+    if model is not None and getattr(model, "preprocessor", None) is not None:
+        preprocessor = model.preprocessor
     else:
-        pplist = config["preprocessing_{}".format(mode)]
-        if pplist is None:
-            raise ValueError("missing preprocessing for '{}' (add entry: '{}')".format(mode, "preprocessing_{}".format(mode)))
-    if not isinstance(pplist, list):
-        pplist = [pplist]
-    for pp in pplist:
-        if pp == "base":
-            df = base(df, config, model)
-        elif pp == "fillna":
-            df = fillna(df, config)
-        elif pp == "target_demean":
-            df = target_demean(df, config, model)
-        elif pp == "target_sign":
-            df = target_sign(df, config, model)
-        elif pp == "polynomialfeatures":
-            df = polynomialfeatures(df, config)
-        elif pp == "target_winsorize":
-            df = target_winsorize(df, config)
-        elif pp == "target_bound":
-            df = target_bound(df, config)
-        elif pp == "target_remove_outliers":
-            df = target_remove_outliers(df, config, no_reduction=no_reduction)
-        else:
-            raise ValueError("Unknown preprocessing module '{}'".format(pp))
+        preprocessor = Preprocessor(config)
+    with stage("preprocess_{}".format(mode)):
+        df = preprocessor.run(df, mode, model, no_reduction, features_only)
     print(". Done.", flush=True)
     return df
 
-def base(df, config, model=None):
+def fitted_value(state, key, module):
+    if key not in state:
+        raise ValueError("{}: statistics not fitted (run the train preprocessing first)".format(module))
+    return state[key]
+
+def base(df, config, model=None, state=None, no_reduction=False):
     print(". base", end="", flush=True)
-#    print(df.dtypes)
-    for c in df.dtypes[df.dtypes == object].index.values:
-        df[c] = (df[c] == True)
-#    print(df)
-#    assert 0
+    columns = df.columns[(df.dtypes == object).values]
+    if len(columns):
+        flags = df[columns].values == True
+        df[columns] = flags.astype(np.uint8) if config["compact"] else flags
     return df
 
-def fillna(df, config):
+def fillna(df, config, model=None, state=None, no_reduction=False):
     print(". fillna", end="", flush=True)
     v = config["fillna"]
     if v is None:
         raise ValueError("fillna value missing from config")
-    df = df.fillna(v)
+    df.fillna(v, inplace=True)
     return df
 
-def target_demean(df, config, model=None):
+def fit_target_demean(df, config, state):
+    state["target_mean"] = float(df[config["target"]].mean())
+
+def target_demean(df, config, model=None, state=None, no_reduction=False):
     print(". target_demean", end="", flush=True)
     target = config["target"]
-    train = df.loc[df.apply(lambda row: config["train_start"] <= row['transactiondate'] < config["train_end"], axis=1)]
-    mean = train[target].mean()
+    mean = fitted_value(state, "target_mean", "target_demean")
     df[target] = df[target].values - mean
     if model is not None:
         model.mean_target = mean
     return df
 
-def target_sign(df, config, model=None):
+def target_sign(df, config, model=None, state=None, no_reduction=False):
     print(". target_sign", end="", flush=True)
     target = config["target"]
     df[target] = (df[target].values >= 0).astype(np.int32)
     return df
 
-def polynomialfeatures(df, config):
+def fit_polynomialfeatures(df, config, state):
+    from sklearn import preprocessing
+    columns = config["polynomialfeatures"]
+    if not isinstance(columns, list) or len(columns) < 2:
+        raise ValueError("polynomialfeatures should list at least two columns")
+    poly = preprocessing.PolynomialFeatures(config["polynomial_degree"] or 3, include_bias=False)
+    poly.fit(np.zeros((1, len(columns))))
+    powers = [p for p in poly.powers_.tolist() if sum(p) > 1] # degree 1 terms are the input columns
+    state["polynomial_powers"] = powers
+    state["polynomial_names"] = ["x".join(["{}^{}".format(c, e) for c, e in zip(columns, p) if e != 0]) for p in powers]
+
+def polynomial_expand(df, config, state):
+    """
+    Fitted polynomial terms of df's input columns as a float32 frame on df's index, computed in row blocks
+    (config: polynomial_block_size)
+    """
+    columns = config["polynomialfeatures"]
+    powers = np.array(fitted_value(state, "polynomial_powers", "polynomialfeatures"), dtype=np.float32)
+    block_size = config["polynomial_block_size"] or 100000
+    x = df[columns].values
+    out = np.empty((len(df), len(powers)), dtype=np.float32)
+    for start in range(0, len(df), block_size):
+        block = x[start:start + block_size].astype(np.float32)
+        out[start:start + block_size] = np.prod(block[:, None, :] ** powers[None, :, :], axis=2)
+    return pd.DataFrame(out, index=df.index, columns=state["polynomial_names"])
+
+def polynomialfeatures(df, config, model=None, state=None, no_reduction=False):
+    if not set(config["polynomialfeatures"]).issubset(df.columns):
+        # features_only frames holding part of the inputs (see BaseModel.submit_month_columns)
+        return df
     print(". polynomialfeatures", end="", flush=True)
-    x1, x2 = config['polynomialfeatures']
-    input_df = df[config['polynomialfeatures']]
-    poly = preprocessing.PolynomialFeatures(3)
-    output_nparray = poly.fit_transform(input_df)
-    target_feature_names = ['x'.join(['{}^{}'.format(pair[0],pair[1]) for pair in tuple if pair[1]!=0]) for tuple in [zip(config['polynomialfeatures'],p) for p in poly.powers_]]
-    output_df = pd.DataFrame(output_nparray, columns = target_feature_names)
-    df.join(output_df)
+    poly = polynomial_expand(df, config, state)
+    df[list(poly.columns)] = poly.values
     return df
 
-def target_winsorize(df, config):
+def fit_target_winsorize(df, config, state):
+    target = config["target"]
+    state["target_winsor"] = [float(df[target].quantile(config["target_winsor_left"])),
+        float(df[target].quantile(config["target_winsor_right"]))]
+
+def target_winsorize(df, config, model=None, state=None, no_reduction=False):
     print(". target_winsorize", end="", flush=True)
     target = config["target"]
-    train = df.loc[df.apply(lambda row: config["train_start"] <= row['transactiondate'] < config["train_end"], axis=1)]
-    left_quantile = train.quantile(config["target_winsor_left"])
-    right_quantile = train.quantile(config["target_winsor_right"])
+    left_quantile, right_quantile = fitted_value(state, "target_winsor", "target_winsorize")
     df[target] = df[target].clip(left_quantile, right_quantile)
     return df
 
-def target_bound(df, config):
+def target_bound(df, config, model=None, state=None, no_reduction=False):
     print(". target_bound", end="", flush=True)
     target = config["target"]
     left_bound = config["target_bound_left"]
@@ -102,13 +181,33 @@ def target_bound(df, config):
     df[target] = df[target].clip(left_bound, right_bound)
     return df
 
-def target_remove_outliers(df, config, no_reduction=False):
+def target_remove_outliers(df, config, model=None, state=None, no_reduction=False):
     if no_reduction:
         return df
     print(". target_remove_outliers", end="", flush=True)
     target = config["target"]
     left_bound = config["target_remove_left"]
     right_bound = config["target_remove_right"]
-    df = df[df[target] > left_bound]
-    df = df[df[target] < right_bound]
-    return df
+    values = df[target].values
+    keep = (values > left_bound) & (values < right_bound)
+    if keep.all():
+        return df
+    return df[keep]
+
+MODULES = {
+    "base": base,
+    "fillna": fillna,
+    "target_demean": target_demean,
+    "target_sign": target_sign,
+    "polynomialfeatures": polynomialfeatures,
+    "target_winsorize": target_winsorize,
+    "target_bound": target_bound,
+    "target_remove_outliers": target_remove_outliers,
+}
+
+# modules fitting statistics on the train split before transforming
+FITTERS = {
+    "target_demean": fit_target_demean,
+    "target_winsorize": fit_target_winsorize,
+    "polynomialfeatures": fit_polynomialfeatures,
+}
@@ -0,0 +1,99 @@
+import os
+import csv
+import json
+import time
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+
+"""
+Stage instrumentation: wall time, cpu time (whole process) and peak RSS of named pipeline stages
+Stages nest, each record holds the path of its enclosing stages ("train/preprocess_train/fillna")
+"""
+_trace = []
+_local = threading.local()
+_lock = threading.Lock()
+
+def peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def reset():
+    with _lock:
+        del _trace[:]
+
+def trace():
+    with _lock:
+        return list(_trace)
+
+@contextmanager
+def stage(name):
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(name)
+    path = "/".join(stack)
+    wall = time.time()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        record = {
+            "stage": path,
+            "start": wall,
+            "wall": time.time() - wall,
+            "cpu": time.process_time() - cpu,
+            "peak_rss_mb": peak_memory_mb(),
+            "thread": threading.current_thread().name,
+        }
+        stack.pop()
+        with _lock:
+            _trace.append(record)
+
+def timed(name):
+    """
+    Decorator running the function as a stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def summarize(records=None):
+    """
+    Total wall/cpu time, number of calls and max peak RSS per stage path, in order of first appearance
+    """
+    summary = dict()
+    for r in trace() if records is None else records:
+        s = summary.setdefault(r["stage"], {"stage": r["stage"], "calls": 0, "wall": 0., "cpu": 0., "peak_rss_mb": 0.})
+        s["calls"] += 1
+        s["wall"] += r["wall"]
+        s["cpu"] += r["cpu"]
+        s["peak_rss_mb"] = max(s["peak_rss_mb"], r["peak_rss_mb"])
+    return list(summary.values())
+
+def print_summary(records=None):
+    print("{:<60} {:>6} {:>10} {:>10} {:>10}".format("stage", "calls", "wall (s)", "cpu (s)", "peak MB"))
+    for s in summarize(records):
+        print("{:<60} {:>6} {:>10.2f} {:>10.2f} {:>10.0f}".format(s["stage"], s["calls"], s["wall"], s["cpu"], s["peak_rss_mb"]))
+
+def write_trace(filename, records=None):
+    """
+    Write the stage records as JSON, or as CSV when filename ends with .csv
+    """
+    records = trace() if records is None else records
+    d = os.path.dirname(filename)
+    if d and not os.path.exists(d):
+        os.makedirs(d)
+    if filename.endswith(".csv"):
+        with open(filename, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["stage", "start", "wall", "cpu", "peak_rss_mb", "thread"])
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(filename, "w") as f:
+            json.dump({"stages": records, "summary": summarize(records)}, f, indent=1)
+    print("Trace written to {}".format(filename))
@@ -1,61 +1,187 @@
-import sys
+import os
+import ast
+import json
+import glob
+import argparse
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 import time
 import traceback
+import cProfile
 import gc
 from config import Config
+from data import join_data, enable_dataset_cache
+import profiling
+from profiling import stage, peak_memory_mb
 
 
+def model_registry():
+    """
+    Map of model name -> module, from the MODEL_NAMES list declared by each model_*.py
+    The sources are parsed, not imported: a backend is only imported when its model is selected
+    """
+    registry = dict()
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_*.py"))):
+        module = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            tree = ast.parse(f.read(), filename=path)
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "MODEL_NAMES" for t in node.targets):
+                for name in ast.literal_eval(node.value):
+                    if name in registry:
+                        raise ValueError("Model '{}' registered by {} and {}".format(name, registry[name], module))
+                    registry[name] = module
+    return registry
+
 def get_model(config):
     name = config["model"]
-    if name == "baseline":
-        from model_baseline import Model
-        return Model(config)
-    elif name == "xgb":
-        from model_xgb import Model
-        return Model(config)
-    elif name == "xgb_sign":
-        from model_xgb_sign import Model
-        return Model(config)
-    elif name.startswith('sklearn'):
-        from model_sklearn import Model
-        return Model(config)
-    elif name == "lgb":
-        from model_lgb import Model
-        return Model(config)
-    else:
+    registry = model_registry()
+    if name not in registry:
         raise ValueError("Model '{}' in not registered!".format(name))
+    return importlib.import_module(registry[name]).Model(config)
 
 def run(config):
+    """
+    Train (or load) and evaluate the model of config, returns the MAE of each evaluated category
+    """
     model = get_model(config)
     print ('has_params=', model.has_params())
     if not model.has_params() or config["force_rerun"]:
-        model.train()
+        with stage("train"):
+            model.train()
         model.save()
     else:
-        model.load()
-    model.eval()
+        with stage("load"):
+            model.load()
+    with stage("eval"):
+        scores = model.eval()
     del model
     gc.collect()
-    return
+    return scores or dict()
 
+def format_time(s):
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return "%d:%02d:%02d" % (h, m, s)
 
-if __name__  == "__main__":
-    configs = sys.argv[1:]
+def run_config(cfg, nthread=None, trace_dir=None):
+    """
+    Run one config file, crashes are reported (not raised) in the returned summary
+    nthread: thread budget of the model when the config does not set it
+    trace_dir: where to write the stage trace when the config has no trace_file entry
+    The config entry profile_file enables a cProfile capture of the run (pstats file)
+    """
+    t = time.time()
+    summary = {"config": cfg, "status": "ok", "mae": None}
+    profiling.reset()
+    profiler = None
+    trace_file = None
+    if trace_dir is not None:
+        trace_file = os.path.join(trace_dir, os.path.splitext(os.path.basename(cfg))[0] + ".trace.json")
+    try:
+        print("#" * 80)
+        print("RUNNING {}".format(cfg))
+        print("#" * 80)
+        config = Config(cfg)
+        if nthread is not None and config["nthread"] is None:
+            config["nthread"] = nthread
+        print(str(config))
+        trace_file = config["trace_file"] or trace_file
+        if config["profile_file"] is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        summary["mae"] = run(config)
+    except:
+        print("RUN CRASHED!\n########### TRACE ###########".format(cfg))
+        traceback.print_exc()
+        print("######## END OF TRACE ########".format(cfg))
+        summary["status"] = "crashed"
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(config["profile_file"])
+        print("Profile written to {}".format(config["profile_file"]))
+    summary["runtime"] = time.time() - t
+    summary["peak_rss_mb"] = peak_memory_mb()
+    profiling.print_summary()
+    if trace_file is not None:
+        profiling.write_trace(trace_file)
+        summary["trace"] = trace_file
+    print("\nTOTAL RUNTIME = {}".format(format_time(summary["runtime"])))
+    return summary
+
+def preload_data(configs):
+    """
+    Fill the joined dataset cache of data.py before forking: workers share it copy-on-write
+    One join per labeled_only holding the union of the configs' features, which serves every config
+    """
+    columns = set()
+    submit = False
     for cfg in configs:
-        t = time.time()
-        try:
-            print("#" * 80)
-            print("RUNNING {}".format(cfg))
-            print("#" * 80)
-            config = Config(cfg)
-            print(str(config))
-            run(config)
-        except:
-            print("RUN CRASHED!\n########### TRACE ###########".format(cfg))
-            traceback.print_exc()
-            print("######## END OF TRACE ########".format(cfg))
-        s = time.time() - t
-        m, s = divmod(s, 60)
-        h, m = divmod(m, 60)
-        total_time = "%d:%02d:%02d" % (h, m, s)
-        print("\nTOTAL RUNTIME = {}".format(total_time))
+        config = Config(cfg)
+        if columns is not None:
+            columns = None if config["features"] is None else columns | set(config["features"])
+        submit = submit or bool(config["submit"])
+    join_data(columns=columns, labeled_only=True)
+    if submit:
+        join_data(columns=columns, labeled_only=False)
+
+def run_configs(configs, jobs=1, trace_dir=None):
+    """
+    Run the configs in jobs forked workers, each model getting cpu_count // jobs threads
+    The joined datasets are cached across the configs of a sweep (a single config doesn't need it)
+    """
+    if len(configs) > 1:
+        enable_dataset_cache()
+    if jobs <= 1:
+        return [run_config(cfg, trace_dir=trace_dir) for cfg in configs]
+    jobs = min(jobs, len(configs))
+    nthread = max(1, (os.cpu_count() or 1) // jobs)
+    print("Running {} configs in {} workers ({} threads each)".format(len(configs), jobs, nthread))
+    preload_data(configs)
+    # one fresh fork per config (single worker executor): the shared data is inherited, the peak RSS is per run
+    # and a dying worker (OOM kill, segfault) only loses its own run
+    context = multiprocessing.get_context("fork")
+    pending = list(enumerate(configs))
+    running = dict()
+    summaries = [None] * len(configs)
+    while pending or running:
+        while pending and len(running) < jobs:
+            i, cfg = pending.pop(0)
+            executor = ProcessPoolExecutor(1, mp_context=context)
+            running[executor.submit(run_config, cfg, nthread, trace_dir)] = (i, cfg, executor, time.time())
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            i, cfg, executor, t = running.pop(future)
+            executor.shutdown()
+            try:
+                summaries[i] = future.result()
+            except BrokenProcessPool:
+                print("RUN CRASHED! Worker of {} died".format(cfg))
+                summaries[i] = {"config": cfg, "status": "crashed", "mae": None, "runtime": time.time() - t, "peak_rss_mb": float("nan")}
+    return summaries
+
+def write_summary(summaries, filename):
+    with open(filename, "w") as f:
+        json.dump(summaries, f, indent=1, default=float)
+    print("Summary written to {}".format(filename))
+
+
+if __name__  == "__main__":
+    parser = argparse.ArgumentParser(description="Run experiments from config files")
+    parser.add_argument("configs", nargs="+", help="config files")
+    parser.add_argument("--jobs", type=int, default=1, help="number of configs run concurrently")
+    parser.add_argument("--summary", default=None, help="write a JSON summary (config, status, runtime, MAE, peak RSS) of the runs")
+    parser.add_argument("--trace", default=None, help="directory of the per-run stage traces (JSON, see profiling.py)")
+    args = parser.parse_args()
+    t = time.time()
+    summaries = run_configs(args.configs, args.jobs, args.trace)
+    if len(summaries) > 1:
+        print("\n" + "#" * 80)
+        for summary in summaries:
+            mae = " ".join("{}={:.7f}".format(cat, score) for cat, score in sorted((summary["mae"] or {}).items()))
+            print("{} [{}] {} peak {:.0f} MB {}".format(summary["config"], summary["status"], format_time(summary["runtime"]), summary["peak_rss_mb"], mae))
+        print("SWEEP RUNTIME = {}".format(format_time(time.time() - t)))
+    if args.summary is not None:
+        write_summary(summaries, args.summary)
@@ -2,10 +2,7 @@ from __future__ import print_function
 import sys, os
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import statsmodels.api as sm
-from scipy.stats import kurtosis, skew
-from data import read_train
+from data import read_train, select_date_window
 
 
 def gaussian(x, mu, sig):
@@ -26,12 +23,15 @@ def print_info(plot=False):
 
 
 def get_period_info(df, start_date, end_date, color, plot=False):
-    sub_df = df.loc[df.apply(lambda row: start_date <= row['transactiondate'] < end_date, axis=1)]
+    from scipy.stats import kurtosis, skew
+    sub_df = select_date_window(df, start_date, end_date)
     mu = sub_df['logerror'].mean()
     sig = sub_df['logerror'].std()
     histogram_df = pd.DataFrame({'logerror': sub_df['logerror']})
 
     if plot:
+        import matplotlib.pyplot as plt
+        import statsmodels.api as sm
         plt.hist(histogram_df.values, bins='auto', range=(-0.5, 0.5), normed=True)
         x = np.linspace(-0.5, 0.5, num=100)
         plt.plot(x, gaussian(x, mu, sig), color)
@@ -48,6 +48,7 @@ def get_period_info(df, start_date, end_date, color, plot=False):
 
 
 def plot_error_distribution(ypred, ytrue=None, title=None, output_fig=None, rng=(-0.4,0.4)):
+    import matplotlib.pyplot as plt
     fig,ax = plt.subplots(2)
     if ytrue is None:
         ax[0].hist(ypred, bins='auto', range=rng, normed=True, label="pred")